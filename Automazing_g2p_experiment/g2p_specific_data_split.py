@@ -1,49 +1,86 @@
 #!/usr/bin/env python
 """Performs a 80-10-10 split of the data.
 This script is totally agnostic to the data format, except that it assumes one
-example per line."""
+example per line. Each example is assigned to a subset by a seeded hash of its
+word, so the split is made in a single pass in constant memory, all entries for
+a word end up in the same subset, and adding examples does not move any others.
+Optionally, the data is also split into k folds in the same pass."""
 
 
 import argparse
+import contextlib
+import hashlib
 import logging
-import random
+
+from typing import List, TextIO, Tuple
+
+# Output buffer size in bytes.
+BUFFER_SIZE = 1 << 20
+
+
+def _assign(word: str, seed: int) -> Tuple[float, float]:
+    """Hashes a word to two independent uniform values in [0, 1).
+
+    The first picks the subset and the second the fold."""
+    digest = hashlib.blake2b(
+        word.encode("utf8"), digest_size=16, key=str(seed).encode("utf8")
+    ).digest()
+    return (
+        int.from_bytes(digest[:8], "big") / (1 << 64),
+        int.from_bytes(digest[8:], "big") / (1 << 64),
+    )
+
+
+def _open_sink(stack: contextlib.ExitStack, path: str) -> TextIO:
+    return stack.enter_context(open(path, "w", buffering=BUFFER_SIZE))
 
 
 def main(args: argparse.Namespace) -> None:
-    # Reads in data and shuffles.
-    with open(args.input_path, "r") as source:
-        data = [line.rstrip() for line in source]
-    random.seed(args.seed)
-    random.shuffle(data)
-    # Creates split boundaries.
-    train_right = int(len(data) * 0.8)
-    dev_right = int(len(data) * 0.9)
-    # Writes them out.
-    subset = data[:train_right]
-    logging.info("Train set:\t%d lines", len(subset))
-    with open(args.train_path, "w") as sink:
-        for line in subset:
-            print(line, file=sink)
-    subset = data[train_right:dev_right]
-    logging.info("Development set:\t%d lines", len(subset))
-    with open(args.g_dev_path, "w") as sink:
-        for line in subset:
-            line = line.split('\t')[0]
-            print(line, file=sink)
-    with open(args.p_dev_path, "w") as sink:
-        for line in subset:
-            line = line.split('\t')[1]
-            print(line, file=sink)
-    subset = data[dev_right:]
-    logging.info("Test set:\t\t%d lines", len(subset))
-    with open(args.g_test_path, "w") as sink:
-        for line in subset:
-            line = line.split('\t')[0]
-            print(line, file=sink)
-    with open(args.p_test_path, "w") as sink:
-        for line in subset:
-            line = line.split('\t')[1]
-            print(line, file=sink)
+    counts = [0, 0, 0]
+    with contextlib.ExitStack() as stack:
+        train_sink = _open_sink(stack, args.train_path)
+        # Grapheme and phoneme sinks of the development and test sets.
+        column_sinks = [
+            (_open_sink(stack, g_path), _open_sink(stack, p_path))
+            for (g_path, p_path) in (
+                (args.g_dev_path, args.p_dev_path),
+                (args.g_test_path, args.p_test_path),
+            )
+        ]
+        fold_sinks: List[Tuple[TextIO, TextIO]] = []
+        for fold in range(args.folds):
+            fold_sinks.append(
+                (
+                    _open_sink(stack, f"{args.fold_prefix}{fold}.train.tsv"),
+                    _open_sink(stack, f"{args.fold_prefix}{fold}.test.tsv"),
+                )
+            )
+        with open(args.input_path, "r") as source:
+            for line in source:
+                line = line.rstrip()
+                (g, p) = line.split("\t")[:2]
+                (subset, fold) = _assign(g, args.seed)
+                # Creates split boundaries.
+                index = 0 if subset < 0.8 else 1 if subset < 0.9 else 2
+                counts[index] += 1
+                if index == 0:
+                    print(line, file=train_sink)
+                else:
+                    (g_sink, p_sink) = column_sinks[index - 1]
+                    print(g, file=g_sink)
+                    print(p, file=p_sink)
+                if fold_sinks:
+                    fold = int(fold * args.folds)
+                    for (other, (fold_train, fold_test)) in enumerate(
+                        fold_sinks
+                    ):
+                        sink = fold_test if other == fold else fold_train
+                        print(line, file=sink)
+    logging.info("Train set:\t%d lines", counts[0])
+    logging.info("Development set:\t%d lines", counts[1])
+    logging.info("Test set:\t\t%d lines", counts[2])
+    if args.folds:
+        logging.info("%d folds written", args.folds)
 
 
 if __name__ == "__main__":
@@ -53,7 +90,7 @@ if __name__ == "__main__":
         "--seed",
         type=int,
         required=True,
-        help="Random seed for shuffling data",
+        help="Random seed for hashing data",
     )
     parser.add_argument("--input_path", required=True, help="Input data path")
     parser.add_argument(
@@ -71,4 +108,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--p_test_path", required=True, help="Output phoneme test data path"
     )
-    main(parser.parse_args())
\ No newline at end of file
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=0,
+        help="Number of folds to also split the data into (default: none)",
+    )
+    parser.add_argument(
+        "--fold_prefix",
+        default="fold",
+        help="Output fold path prefix, written as PREFIX{fold}.train.tsv and "
+        "PREFIX{fold}.test.tsv (default: %(default)s)",
+    )
+    main(parser.parse_args())
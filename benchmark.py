@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+"""Benchmarks training, decoding and evaluation throughput.
+
+A synthetic lexicon is generated with the given size, alphabets and word
+length distribution. Each stage of training a model on it is timed, as is
+decoding throughput against the number of worker processes and against the
+input length, and scoring throughput of the evaluation. Results are written
+as JSON.
+
+Given a --baseline_path, the results are compared with those of an earlier
+run, and any benchmark slower by more than --threshold is flagged as a
+regression; with --current_path too, the two files are compared without
+running anything. The exit status is 1 if there are regressions."""
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pynini
+
+import build_sym
+import bundle
+import evaluate
+import rewrite
+import train
+
+
+Results = Dict[str, Dict[str, Any]]
+
+
+def _lengths(
+    args: argparse.Namespace, rng: random.Random
+) -> Callable[[], int]:
+    """Returns a sampler of word lengths from the configured distribution."""
+    if args.length_distribution == "uniform":
+        return lambda: rng.randint(args.min_length, args.max_length)
+
+    def _normal() -> int:
+        length = round(rng.gauss(args.mean_length, args.sd_length))
+        return min(max(length, args.min_length), args.max_length)
+
+    return _normal
+
+
+class _Lexicon:
+    """Generator of synthetic lexicon entries.
+
+    Each grapheme is pronounced as a fixed string of zero to two phonemes,
+    so there is a consistent alignment for the model to learn; with
+    probability `noise`, each phoneme of an entry is replaced by a random
+    one."""
+
+    def __init__(
+        self, graphemes: str, phonemes: str, noise: float, seed: int
+    ):
+        self.graphemes = graphemes
+        self.phonemes = phonemes
+        self.noise = noise
+        rng = random.Random(seed)
+        self.mapping = {
+            grapheme: "".join(
+                rng.choice(phonemes)
+                for _ in range(rng.choices((0, 1, 2), (1, 7, 2))[0])
+            )
+            for grapheme in graphemes
+        }
+
+    def word(self, rng: random.Random, length: int) -> str:
+        return "".join(rng.choice(self.graphemes) for _ in range(length))
+
+    def perturb(self, rng: random.Random, pron: str) -> str:
+        return "".join(
+            rng.choice(self.phonemes) if rng.random() < self.noise else p
+            for p in pron
+        )
+
+    def pron(self, rng: random.Random, word: str) -> str:
+        pron = "".join(self.mapping[grapheme] for grapheme in word)
+        return self.perturb(rng, pron) or rng.choice(self.phonemes)
+
+
+def _write_lexicon(
+    path: str, lexicon: _Lexicon, words: List[str], seed: int
+) -> List[Tuple[str, str]]:
+    rng = random.Random(seed)
+    pairs = [(word, lexicon.pron(rng, word)) for word in words]
+    with open(path, "w") as sink:
+        for (word, pron) in pairs:
+            print(word, pron, sep="\t", file=sink)
+    return pairs
+
+
+def _result(samples: List[float], unit: str, higher_is_better: bool):
+    """Summarizes repeated measurements by their median."""
+    return {
+        "value": statistics.median(samples),
+        "unit": unit,
+        "higher_is_better": higher_is_better,
+        "samples": samples,
+    }
+
+
+def _throughput(
+    run: Callable[[], Any], count: int, unit: str, repeats: int
+) -> Dict[str, Any]:
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        run()
+        samples.append(count / (time.perf_counter() - started))
+    return _result(samples, unit, True)
+
+
+def _bench_train(
+    args: argparse.Namespace, lexicon_path: str, model_path: str
+) -> Results:
+    """Times each trainer stage, with no stage cache so that all run."""
+    stages: Dict[str, List[float]] = collections.defaultdict(list)
+    totals = []
+    for _ in range(args.repeats):
+        trainer = train.PairNGramTrainer(args.processes)
+        started = time.perf_counter()
+        trainer.train(
+            lexicon_path,
+            args.token_type,
+            True,
+            True,
+            args.order,
+            args.target_number_of_ngrams,
+            args.smoothing_method,
+            False,
+            model_path,
+        )
+        totals.append(time.perf_counter() - started)
+        times: Dict[str, float] = collections.Counter()
+        for record in trainer.report:
+            times[record["stage"]] += record["wall_time"]
+        for (stage, wall_time) in times.items():
+            stages[stage].append(wall_time)
+    results = {"train.total": _result(totals, "s", False)}
+    for (stage, samples) in stages.items():
+        results[f"train.{stage}"] = _result(samples, "s", False)
+    return results
+
+
+def _bench_workers(
+    args: argparse.Namespace, fst_path: str, words: List[str]
+) -> Results:
+    """Measures decoding throughput in words/s per number of workers."""
+    results = {}
+    for workers in args.workers:
+        with rewrite.G2PModel(
+            fst_path,
+            args.token_type,
+            args.fst_type,
+            workers=workers,
+            batch_size=args.decode_batch_size,
+        ) as model:
+            # Starts up and warms the workers.
+            model.transcribe_batch(words[: workers * args.decode_batch_size])
+            results[f"rewrite.workers_{workers}"] = _throughput(
+                lambda: model.transcribe_batch(words),
+                len(words),
+                "words/s",
+                args.repeats,
+            )
+        logging.info(
+            "%d workers:\t%.0f words/s",
+            workers,
+            results[f"rewrite.workers_{workers}"]["value"],
+        )
+    return results
+
+
+def _bench_lengths(
+    args: argparse.Namespace, fst_path: str, lexicon: _Lexicon
+) -> Results:
+    """Measures in-process _Rewriter.rewrite throughput per word length."""
+    rewriter = rewrite._Rewriter.from_args(
+        fst_path, args.token_type, args.fst_type
+    )
+    rng = random.Random(args.seed + 2)
+    results = {}
+    for length in args.input_lengths:
+        words = [lexicon.word(rng, length) for _ in range(args.length_size)]
+        if not isinstance(rewriter.token_type, str):
+            # As G2PModel does before handing words to the workers.
+            words = [build_sym._tokenize(word) for word in words]
+        results[f"rewrite.length_{length}"] = _throughput(
+            lambda: [rewriter.rewrite(word) for word in words],
+            len(words),
+            "words/s",
+            args.repeats,
+        )
+        logging.info(
+            "Length %d:\t%.0f words/s",
+            length,
+            results[f"rewrite.length_{length}"]["value"],
+        )
+    return results
+
+
+def _bench_evaluate(
+    args: argparse.Namespace,
+    lexicon: _Lexicon,
+    pairs: List[Tuple[str, str]],
+) -> Results:
+    """Measures scoring throughput, with and without confusions."""
+    rng = random.Random(args.seed + 3)
+    scored = [(gold, lexicon.perturb(rng, gold)) for (_, gold) in pairs]
+    batches = [
+        scored[start : start + args.score_batch_size]
+        for start in range(0, len(scored), args.score_batch_size)
+    ]
+    results = {
+        "evaluate.score": _throughput(
+            lambda: [evaluate._score_batch(batch) for batch in batches],
+            len(scored),
+            "pairs/s",
+            args.repeats,
+        ),
+        "evaluate.score_confusions": _throughput(
+            lambda: [
+                evaluate._score_batch(batch, collections.Counter())
+                for batch in batches
+            ],
+            len(scored),
+            "pairs/s",
+            args.repeats,
+        ),
+    }
+    logging.info(
+        "Scoring:\t%.0f pairs/s (%.0f pairs/s with confusions)",
+        results["evaluate.score"]["value"],
+        results["evaluate.score_confusions"]["value"],
+    )
+    return results
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run(args: argparse.Namespace) -> Dict[str, Any]:
+    lexicon = _Lexicon(args.graphemes, args.phonemes, args.noise, args.seed)
+    rng = random.Random(args.seed)
+    sample_length = _lengths(args, rng)
+    words = [lexicon.word(rng, sample_length()) for _ in range(args.size)]
+    decode_words = [
+        lexicon.word(rng, sample_length()) for _ in range(args.decode_size)
+    ]
+    results: Results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark.") as tmp:
+        lexicon_path = os.path.join(tmp, "lexicon.tsv")
+        pairs = _write_lexicon(lexicon_path, lexicon, words, args.seed + 1)
+        fst_path = args.fst_path
+        if fst_path is None:
+            fst_path = os.path.join(tmp, "model.fst")
+            results.update(_bench_train(args, lexicon_path, fst_path))
+        results.update(_bench_workers(args, fst_path, decode_words))
+        results.update(_bench_lengths(args, fst_path, lexicon))
+        results.update(_bench_evaluate(args, lexicon, pairs))
+    params = {
+        key: value
+        for (key, value) in vars(args).items()
+        if key not in {"results_path", "baseline_path", "current_path"}
+    }
+    return {
+        "params": params,
+        "environment": {
+            "revision": _revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "pynini": getattr(pynini, "__version__", None),
+        },
+        "started": time.time(),
+        "benchmarks": results,
+    }
+
+
+def _compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float
+) -> List[str]:
+    """Logs the change of each benchmark; returns those that regressed.
+
+    A benchmark regresses if it got worse by more than `threshold`, relative
+    to the baseline."""
+    regressions = []
+    for (name, result) in sorted(current["benchmarks"].items()):
+        base = baseline["benchmarks"].get(name)
+        if base is None or not base["value"]:
+            logging.info(
+                "%s:\t%.4g %s (new)", name, result["value"], result["unit"]
+            )
+            continue
+        change = result["value"] / base["value"] - 1
+        worse = -change if result["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "\tREGRESSION"
+        logging.info(
+            "%s:\t%.4g -> %.4g %s (%+.1f%%)%s",
+            name,
+            base["value"],
+            result["value"],
+            result["unit"],
+            100 * change,
+            flag,
+        )
+    for name in sorted(baseline["benchmarks"].keys() - current["benchmarks"]):
+        logging.warning("%s:\tmissing from the current run", name)
+    if regressions:
+        logging.warning(
+            "%d of %d benchmarks regressed by more than %.0f%%",
+            len(regressions),
+            len(current["benchmarks"]),
+            100 * threshold,
+        )
+    return regressions
+
+
+def _read(path: str) -> Dict[str, Any]:
+    with open(path, "r") as source:
+        return json.load(source)
+
+
+def main(args: argparse.Namespace) -> int:
+    if args.current_path:
+        current = _read(args.current_path)
+    else:
+        current = _run(args)
+        with open(args.results_path, "w") as sink:
+            json.dump(current, sink, indent=2)
+        logging.info("Results are written to %s", args.results_path)
+    if not args.baseline_path:
+        return 0
+    regressions = _compare(
+        _read(args.baseline_path), current, args.threshold
+    )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--results_path",
+        default="benchmark.json",
+        help="path to output results JSON (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--baseline_path",
+        help="path to results JSON of an earlier run to compare with",
+    )
+    parser.add_argument(
+        "--current_path",
+        help="path to results JSON to compare with --baseline_path, "
+        "instead of running the benchmarks",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown flagged as a regression "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="number of runs of each benchmark; the median is reported "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed (default: %(default)s)",
+    )
+    # Synthetic lexicon.
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=5000,
+        help="number of lexicon entries (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--graphemes",
+        default="abcdefghijklmnopqrstuvwxyz",
+        help="grapheme alphabet (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--phonemes",
+        default="abdefhijklmnoprstuvwzæðŋɑɔəɛɡɪʃʊʌʒθ",
+        help="phoneme alphabet (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--length_distribution",
+        default="normal",
+        choices=("normal", "uniform"),
+        help="distribution of word lengths (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--mean_length",
+        type=float,
+        default=7,
+        help="mean word length of the normal distribution "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sd_length",
+        type=float,
+        default=2,
+        help="standard deviation of word length of the normal distribution "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min_length",
+        type=int,
+        default=1,
+        help="minimum word length (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_length",
+        type=int,
+        default=20,
+        help="maximum word length (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.05,
+        help="probability of replacing each phoneme by a random one "
+        "(default: %(default)s)",
+    )
+    # Training.
+    parser.add_argument(
+        "--fst_path",
+        help="path to an existing model to decode with, skipping the "
+        "training benchmark; its alphabets should match the lexicon's",
+    )
+    parser.add_argument(
+        "--order",
+        type=int,
+        default=4,
+        help="n-gram order (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--smoothing_method",
+        default="kneser_ney",
+        help="smoothing method (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--target_number_of_ngrams",
+        type=int,
+        default=100000,
+        help="target number of n-grams (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="number of training processes (default: number of CPUs)",
+    )
+    # Decoding.
+    parser.add_argument(
+        "--token_type",
+        default="utf8",
+        help="token type the model is trained and decoded with "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--fst_type",
+        default="vector",
+        choices=bundle.FST_TYPES,
+        help="FST type the model is prepared as for decoding "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--decode_size",
+        type=int,
+        default=2000,
+        help="number of words decoded per worker count "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="numbers of worker processes to decode with "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--decode_batch_size",
+        type=int,
+        default=128,
+        help="number of words per worker task (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--input_lengths",
+        type=int,
+        nargs="+",
+        default=[4, 8, 16],
+        help="word lengths to measure single-process decoding at "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--length_size",
+        type=int,
+        default=500,
+        help="number of words decoded per length (default: %(default)s)",
+    )
+    # Evaluation.
+    parser.add_argument(
+        "--score_batch_size",
+        type=int,
+        default=4096,
+        help="number of pairs scored per kernel call (default: %(default)s)",
+    )
+    sys.exit(main(parser.parse_args()))
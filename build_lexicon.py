@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Compiles a lexicon index from TSV file.
+
+The index maps each word to its most frequent pronunciation, in the same
+tokenization that rewrite.py uses, so that in-vocabulary words can be looked
+up before falling back to FST composition."""
+
+import argparse
+import collections
+import logging
+import pickle
+
+from typing import Dict
+
+import build_sym
+
+
+Lexicon = Dict[str, str]
+
+
+def _compile(input_path: str, token_type: str) -> Lexicon:
+    """Builds the index from a two-column TSV filepath."""
+    counts = collections.defaultdict(collections.Counter)
+    with open(input_path, "r") as source:
+        for line in source:
+            (g, p) = line.rstrip().split("\t", 1)
+            if token_type not in {"byte", "utf8"}:
+                g = build_sym._tokenize(g)
+                p = build_sym._tokenize(p)
+            counts[g][p] += 1
+    # Counter.most_common breaks ties by insertion order, so the first
+    # pronunciation in the file wins among equally frequent ones.
+    return {g: c.most_common(1)[0][0] for (g, c) in counts.items()}
+
+
+def _read(path: str) -> Lexicon:
+    with open(path, "rb") as source:
+        return pickle.load(source)
+
+
+def _write(lexicon: Lexicon, path: str) -> None:
+    with open(path, "wb") as sink:
+        pickle.dump(lexicon, sink, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def main(args: argparse.Namespace) -> None:
+    lexicon = _compile(args.input_path, args.token_type)
+    logging.info("%d unique words", len(lexicon))
+    _write(lexicon, args.lexicon_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--input_path", required=True, help="input TSV file path"
+    )
+    parser.add_argument(
+        "--token_type",
+        default="utf8",
+        help="token type used by the model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--lexicon_path", required=True, help="output lexicon index path"
+    )
+    main(parser.parse_args())
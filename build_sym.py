@@ -3,51 +3,134 @@
 """Compiles a SymbolTable from TSV file."""
 
 import argparse
+import functools
+import re
+import sys
 import unicodedata
 
-from typing import List
+from typing import FrozenSet, List, NamedTuple, Pattern, Tuple
 
-import pynini
+
+# Modifier letters kept together with the character they follow.
+MODS = frozenset(
+    {
+        "ˡ",
+        "ˍ",
+        "ʲ",
+        "ˠ",
+        "˺",
+        "ː",
+        "˞",
+        "˽",
+        "ˬ",
+        "˖",
+        "ʰ",
+        "ˤ",
+        "˳",
+        "˟",
+        "ⁿ",
+        "ʷ",
+        "˕",
+        "ˌ",
+        "˷",
+        "˔",
+    }
+)
+
+# Number of distinct tokens whose tokenization is memoized.
+CACHE_SIZE = 1 << 16
+
+
+# Characters outside the Basic Multilingual Plane. Regex character classes
+# with such ranges are matched by a slow linear scan, so tokens containing
+# them are split character by character instead.
+_ASTRAL = re.compile("[\U00010000-\U0010ffff]")
+
+
+class _Patterns(NamedTuple):
+    mods: FrozenSet[str]
+    cluster: Pattern
+    spacer: Pattern
+    leading: Pattern
+
+
+@functools.lru_cache(maxsize=None)
+def _patterns() -> _Patterns:
+    """Compiles the tokenizer.
+
+    Returns all modifiers, and regexes matching a character with the
+    modifiers following it, the positions between two characters where a
+    new character starts, and a modifier at the start of a line. Scanning
+    the code points for combining characters takes a while, so this is only
+    done on first use."""
+    mods = set(MODS)
+    mods.update(
+        chr(codepoint)
+        for codepoint in range(sys.maxunicode + 1)
+        if unicodedata.combining(chr(codepoint))
+    )
+    bmp = "".join(
+        re.escape(char) for char in sorted(mods) if ord(char) < 0x10000
+    )
+    return _Patterns(
+        frozenset(mods),
+        re.compile(f".[{bmp}]*", re.DOTALL),
+        re.compile(f"(?<=[^\\n])(?=[^\\n{bmp}])"),
+        re.compile(f"^[{bmp}]", re.MULTILINE),
+    )
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _clusters(token: str) -> Tuple[str, ...]:
+    """Splits a token into characters with unseparated diacritics."""
+    patterns = _patterns()
+    if _ASTRAL.search(token):
+        chars = []
+        for char in token:
+            # Keep combining characters together
+            if char in patterns.mods:
+                m = chars.pop()
+                chars.append(f"{m}{char}")
+            else:
+                chars.append(char)
+        return tuple(chars)
+    if patterns.leading.match(token):
+        raise IndexError("pop from empty list")
+    return tuple(patterns.cluster.findall(token))
 
 
 def _char_processor(token: str) -> List[str]:
     """Returns a list of characters with unseparated diacritics."""
-    MODS = frozenset(
-        {
-            "ˡ",
-            "ˍ",
-            "ʲ",
-            "ˠ",
-            "˺",
-            "ː",
-            "˞",
-            "˽",
-            "ˬ",
-            "˖",
-            "ʰ",
-            "ˤ",
-            "˳",
-            "˟",
-            "ⁿ",
-            "ʷ",
-            "˕",
-            "ˌ",
-            "˷",
-            "˔",
-        }
-    )
-    chars = []
-    for char in token:
-        # Keep combining characters together
-        if unicodedata.combining(char) or char in MODS:
-            m = chars.pop()
-            chars.append(f"{m}{char}")
-        else:
-            chars.append(char)
-    return chars
+    return list(_clusters(token))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _tokenize(token: str) -> str:
+    """Returns the characters of a token with unseparated diacritics, joined
+    by spaces, as a symbol table token type expects them."""
+    patterns = _patterns()
+    if _ASTRAL.search(token) or patterns.leading.match(token):
+        return " ".join(_clusters(token))
+    return patterns.spacer.sub(" ", token)
+
+
+def _tokenize_batch(tokens: List[str]) -> List[str]:
+    """Tokenizes many tokens at once, as _tokenize does.
+
+    The tokens are joined into one chunk and spaced out in a single pass, so
+    they must not contain newlines."""
+    if not tokens:
+        return []
+    patterns = _patterns()
+    chunk = "\n".join(tokens)
+    if _ASTRAL.search(chunk) or patterns.leading.search(chunk):
+        return [_tokenize(token) for token in tokens]
+    return patterns.spacer.sub(" ", chunk).split("\n")
 
 
 def main(args: argparse.Namespace) -> None:
+    # The tokenizer is also used for scoring, which does not need pynini.
+    import pynini
 
     syms = set()
     with open(args.input_lexicon, "r") as src:
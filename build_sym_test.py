@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Tests for the tokenizer in build_sym.py."""
+
+import unicodedata
+import unittest
+
+from typing import List
+
+import build_sym
+
+
+def _reference(token: str) -> List[str]:
+    """The original character loop the tokenizer must agree with."""
+    chars = []
+    for char in token:
+        # Keep combining characters together
+        if unicodedata.combining(char) or char in build_sym.MODS:
+            m = chars.pop()
+            chars.append(f"{m}{char}")
+        else:
+            chars.append(char)
+    return chars
+
+
+TOKENS = [
+    "",
+    "a",
+    "cat",
+    "a b",
+    "kát",
+    "é̀",
+    "nʲet",
+    "tʰaː",
+    "t͡s",
+    " ́",
+    "\U0001d400",
+    "x\U0001d400y",
+    "\U0001d400́ʰ",
+    "aʰ\U00010348́",
+    "\U0001f600\U0001f600",
+]
+
+
+class BuildSymTest(unittest.TestCase):
+    def test_char_processor_matches_reference(self):
+        for token in TOKENS:
+            with self.subTest(token=token):
+                self.assertEqual(
+                    build_sym._char_processor(token), _reference(token)
+                )
+
+    def test_tokenize_matches_reference(self):
+        for token in TOKENS:
+            with self.subTest(token=token):
+                self.assertEqual(
+                    build_sym._tokenize(token), " ".join(_reference(token))
+                )
+
+    def test_leading_modifier_raises(self):
+        for token in ["́a", "ʰa", "ʰ\U0001d400", "́"]:
+            with self.subTest(token=token):
+                with self.assertRaisesRegex(IndexError, "pop from empty"):
+                    _reference(token)
+                with self.assertRaisesRegex(IndexError, "pop from empty"):
+                    build_sym._char_processor(token)
+                with self.assertRaisesRegex(IndexError, "pop from empty"):
+                    build_sym._tokenize(token)
+
+    def test_tokenize_batch_matches_tokenize(self):
+        bmp = [
+            token for token in TOKENS if not build_sym._ASTRAL.search(token)
+        ]
+        for tokens in [[], ["a"], bmp, TOKENS, list(reversed(TOKENS))]:
+            with self.subTest(tokens=tokens):
+                self.assertEqual(
+                    build_sym._tokenize_batch(tokens),
+                    [" ".join(_reference(token)) for token in tokens],
+                )
+
+    def test_tokenize_batch_does_not_join_across_tokens(self):
+        # A modifier at the start of a token must not attach to the end of
+        # the previous one when the batch is joined on newlines.
+        with self.assertRaisesRegex(IndexError, "pop from empty"):
+            build_sym._tokenize_batch(["ab", "ʰa"])
+        self.assertEqual(
+            build_sym._tokenize_batch(["ab", "", "cʰ"]), ["a b", "", "cʰ"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Packs a model FST into a single-file bundle for rewrite.py.
+
+A bundle holds the model, already prepared for decoding, together with its
+symbol table (if any), the training parameters and a content hash. It is laid
+out as a magic string, a length-prefixed JSON header and then the serialized
+FST, so the header can be inspected without reading the model."""
+
+import argparse
+import hashlib
+import json
+import logging
+import struct
+
+from typing import Any, BinaryIO, Dict, Tuple, Union
+
+import pynini
+import pywrapfst
+
+
+MAGIC = b"G2PFST\x00\x01"
+_LENGTH = struct.Struct("<Q")
+
+# FST types the model can be prepared as for decoding. "vector" is the
+# mutable FST as written by train.py; "const" is arc-sorted on input labels
+# and converted to the immutable type. Label-lookahead types are left out:
+# converting to them relabels the input side, and every acceptor would have
+# to be relabeled to match before composition.
+FST_TYPES = ("vector", "const")
+
+
+def _prepare(fst: pynini.Fst, fst_type: str) -> pywrapfst.Fst:
+    """Prepares a model FST for decoding."""
+    if fst_type == "vector":
+        return fst
+    fst.arcsort(sort_type="ilabel")
+    return pywrapfst.convert(fst, fst_type=fst_type)
+
+
+def _is_bundle(path: str) -> bool:
+    with open(path, "rb") as source:
+        return source.read(len(MAGIC)) == MAGIC
+
+
+def _write(
+    path: str,
+    fst: pynini.Fst,
+    token_type: Union[str, pynini.SymbolTable],
+    params: Dict[str, Any],
+    fst_type: str = "const",
+) -> str:
+    """Writes a bundle and returns its content hash."""
+    if isinstance(token_type, str):
+        header = {"token_type": token_type}
+    else:
+        # The symbol table travels inside the FST itself.
+        fst.set_input_symbols(token_type)
+        fst.set_output_symbols(token_type)
+        header = {"token_type": "symbols"}
+    payload = _prepare(fst, fst_type).write_to_string()
+    header["fst_type"] = fst_type
+    header["params"] = params
+    header["sha256"] = hashlib.sha256(payload).hexdigest()
+    encoded = json.dumps(header, sort_keys=True).encode("utf8")
+    with open(path, "wb") as sink:
+        sink.write(MAGIC)
+        sink.write(_LENGTH.pack(len(encoded)))
+        sink.write(encoded)
+        sink.write(payload)
+    return header["sha256"]
+
+
+def _header(source: BinaryIO, path: str) -> Dict[str, Any]:
+    """Reads the header, leaving `source` at the start of the FST."""
+    if source.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"Not a model bundle: {path}")
+    (length,) = _LENGTH.unpack(source.read(_LENGTH.size))
+    return json.loads(source.read(length).decode("utf8"))
+
+
+def _read_header(path: str) -> Dict[str, Any]:
+    with open(path, "rb") as source:
+        return _header(source, path)
+
+
+def _read(
+    path: str
+) -> Tuple[pywrapfst.Fst, Union[str, pynini.SymbolTable], Dict[str, Any]]:
+    """Reads the model, its token type and the header from a bundle."""
+    with open(path, "rb") as source:
+        header = _header(source, path)
+        if header["fst_type"] not in FST_TYPES:
+            raise ValueError(
+                f"Unsupported FST type {header['fst_type']}: {path}"
+            )
+        payload = source.read()
+    if header["fst_type"] == "vector":
+        fst = pynini.Fst.read_from_string(payload)
+    else:
+        fst = pywrapfst.Fst.read_from_string(payload)
+    token_type = header["token_type"]
+    if token_type == "symbols":
+        token_type = fst.input_symbols().copy()
+    return (fst, token_type, header)
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.token_type not in {"byte", "utf8"}:
+        token_type = pynini.SymbolTable.read_text(args.token_type)
+    else:
+        token_type = args.token_type
+    params = json.loads(args.params) if args.params else {}
+    digest = _write(
+        args.bundle_path,
+        pynini.Fst.read(args.fst_path),
+        token_type,
+        params,
+        args.fst_type,
+    )
+    logging.info("Wrote %s bundle %s", args.fst_type, digest)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fst_path", required=True, help="input FST path")
+    parser.add_argument(
+        "--token_type",
+        default="utf8",
+        help="token type for acceptors. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--fst_type",
+        default="const",
+        choices=FST_TYPES,
+        help="FST type the model is stored as (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--params", help="training parameters as a JSON object"
+    )
+    parser.add_argument(
+        "--bundle_path", required=True, help="output bundle path"
+    )
+    main(parser.parse_args())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Transcribes words with a running serve.py server.
+
+This script assumes the input is provided one word per line."""
+
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import sys
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import common
+
+
+class Client:
+    """Synchronous client for serve.py."""
+
+    def __init__(
+        self,
+        socket_path: Optional[str] = None,
+        port: Optional[int] = None,
+        host: str = "127.0.0.1",
+    ):
+        if socket_path:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(socket_path)
+        else:
+            self.socket = socket.create_connection((host, port))
+        self.stream = self.socket.makefile("rwb")
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.stream.close()
+        self.socket.close()
+
+    def _request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        self.stream.write(json.dumps(request).encode("utf8") + b"\n")
+        self.stream.flush()
+        response = json.loads(self.stream.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def transcribe_batch(self, words: List[str]) -> List[str]:
+        return self._request({"words": words})["prons"]
+
+    def metrics(self) -> Dict[str, Any]:
+        return self._request({"metrics": True})
+
+
+async def _open_connection(
+    socket_path: Optional[str] = None,
+    port: Optional[int] = None,
+    host: str = "127.0.0.1",
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Opens an asynchronous connection to a serve.py server."""
+    if socket_path:
+        return await asyncio.open_unix_connection(socket_path)
+    return await asyncio.open_connection(host, port)
+
+
+def _add_address_arguments(parser: argparse.ArgumentParser) -> None:
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket_path", help="Unix socket path of server")
+    address.add_argument(
+        "--port", type=int, help="localhost TCP port of server"
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    with Client(args.socket_path, args.port) as client:
+        if args.metrics:
+            print(json.dumps(client.metrics(), indent=2))
+            return
+        for batch in common._batcher(
+            common._reader(args.word_path), args.batch_size
+        ):
+            for pron in client.transcribe_batch(batch):
+                print(pron)
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    _add_address_arguments(parser)
+    parser.add_argument(
+        "--word_path",
+        default="-",
+        help="path to file of words to transcribe, or - for stdin "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="number of words per request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="print the server metrics instead of transcribing",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""Helpers shared by the rewriter, the server and its clients.
+
+Only the standard library is imported here, so the clients run without
+pynini."""
+
+import collections
+import contextlib
+import itertools
+import math
+import sys
+
+from typing import Dict, Iterable, Iterator, List, TextIO, Tuple
+
+
+# Latency percentiles reported in timing summaries and server metrics.
+PERCENTILES = (50, 95, 99)
+
+
+class _Histogram:
+    """Latency histogram with logarithmic buckets.
+
+    Each bucket is 5% wider than the last, so percentiles are accurate to
+    within 5% in constant memory."""
+
+    BASE = 1.05
+    # Latencies below a microsecond are put in the first bucket.
+    FLOOR = 1e-6
+
+    def __init__(self):
+        self.counts: Dict[int, int] = collections.Counter()
+        self.n = 0
+        self.sum = 0.0
+
+    def add(self, latency: float) -> None:
+        bucket = math.floor(
+            math.log(max(latency, self.FLOOR)) / math.log(self.BASE)
+        )
+        self.counts[bucket] += 1
+        self.n += 1
+        self.sum += latency
+
+    def percentile(self, q: float) -> float:
+        """Returns the upper bound of the bucket of the q-th percentile."""
+        rank = q / 100 * self.n
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self.BASE ** (bucket + 1)
+        return 0.0
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """Lists the upper bound and count of each non-empty bucket."""
+        return [
+            (self.BASE ** (bucket + 1), self.counts[bucket])
+            for bucket in sorted(self.counts)
+        ]
+
+
+@contextlib.contextmanager
+def _open_source(path: str) -> Iterator[TextIO]:
+    """Opens a filepath for reading, with "-" denoting stdin."""
+    if path == "-":
+        yield sys.stdin
+    else:
+        with open(path, "r") as source:
+            yield source
+
+
+def _reader(path: str) -> Iterator[str]:
+    """Reads strings from a single-column filepath."""
+    with _open_source(path) as source:
+        for line in source:
+            yield line.rstrip()
+
+
+def _batcher(tokens: Iterable[str], size: int) -> Iterator[List[str]]:
+    """Groups strings into lists of at most `size` elements."""
+    tokens = iter(tokens)
+    while True:
+        batch = list(itertools.islice(tokens, size))
+        if not batch:
+            return
+        yield batch
@@ -2,51 +2,220 @@
 """Evaluates sequence model.
 
 This script assumes the gold and hypothesis data is stored in a two-column TSV
-file, one example per line."""
+file, one example per line. Alternatively, given a model with --fst_path, it
+reads word and gold TSV data, and decodes and scores the words in one pass with
+no intermediate files."""
 
 
 import argparse
+import collections
+import contextlib
+import itertools
 import logging
-import multiprocessing
 import numpy
 
-from typing import Any, Iterator, List, Tuple
+from typing import (
+    Any,
+    Counter,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+import build_sym
 
 
 Labels = List[Any]
 
+# Maximum number of cells of the edit distance tables kept at once to
+# backtrace alignments.
+TABLE_CELLS = 1 << 22
+
+
+def _edit_rows(xs: List[Labels], ys: List[Labels]) -> Iterator[numpy.ndarray]:
+    """Yields the rows of the edit distance tables for a batch of pairs.
+
+    Each row is filled for the whole batch at once. Within a row,
+    D[i][j] = min_{k <= j} (T[k] + j - k), where T holds the deletion and
+    substitution costs, so the insertion recurrence reduces to a running
+    minimum over T[k] - k."""
+    # Maps labels to integers; gold and hypothesis padding never match.
+    vocabulary: Dict[Any, int] = {}
+    xdim = max((len(x) for x in xs), default=0)
+    ydim = max((len(y) for y in ys), default=0)
+    xarr = numpy.full((len(xs), xdim), -1, dtype=numpy.int64)
+    yarr = numpy.full((len(ys), ydim), -2, dtype=numpy.int64)
+    for (b, (x, y)) in enumerate(zip(xs, ys)):
+        xarr[b, : len(x)] = [
+            vocabulary.setdefault(l, len(vocabulary)) for l in x
+        ]
+        yarr[b, : len(y)] = [
+            vocabulary.setdefault(l, len(vocabulary)) for l in y
+        ]
+    cols = numpy.arange(ydim + 1, dtype=numpy.int64)
+    row = numpy.tile(cols, (len(xs), 1))
+    yield row
+    for i in range(1, xdim + 1):
+        costs = numpy.empty_like(row)
+        costs[:, 0] = i
+        numpy.minimum(
+            row[:, 1:] + 1,
+            row[:, :-1] + (xarr[:, i - 1, None] != yarr),
+            out=costs[:, 1:],
+        )
+        row = numpy.minimum.accumulate(costs - cols, axis=1) + cols
+        yield row
+
+
+def _edit_distances(xs: List[Labels], ys: List[Labels]) -> numpy.ndarray:
+    """Computes the edit distances for a batch of label sequence pairs."""
+    xlen = numpy.array([len(x) for x in xs], dtype=numpy.int64)
+    ylen = numpy.array([len(y) for y in ys], dtype=numpy.int64)
+    distances = numpy.empty_like(ylen)
+    for (i, row) in enumerate(_edit_rows(xs, ys)):
+        done = xlen == i
+        distances[done] = row[done, ylen[done]]
+    return distances
+
 
 def _edit_distance(x: Labels, y: Labels) -> int:
-    # For a more expressive version of the same, see:
-    #
-    #     https://gist.github.com/kylebgorman/8034009
-    idim = len(x) + 1
-    jdim = len(y) + 1
-    table = numpy.zeros((idim, jdim), dtype=numpy.uint8)
-    table[1:, 0] = 1
-    table[0, 1:] = 1
-    for i in range(1, idim):
-        for j in range(1, jdim):
-            if x[i - 1] == y[j - 1]:
-                table[i][j] = table[i - 1][j - 1]
+    return int(_edit_distances([x], [y])[0])
+
+
+def _edit_operations(
+    table: numpy.ndarray, x: Labels, y: Labels
+) -> Iterator[Tuple[Any, Any]]:
+    """Backtraces one alignment through an edit distance table.
+
+    Yields (gold, hypo) label pairs, with None standing for the empty side of
+    an insertion or deletion."""
+    (i, j) = (len(x), len(y))
+    while i or j:
+        if (
+            i
+            and j
+            and table[i, j] == table[i - 1, j - 1] + (x[i - 1] != y[j - 1])
+        ):
+            (i, j) = (i - 1, j - 1)
+            yield (x[i], y[j])
+        elif i and table[i, j] == table[i - 1, j] + 1:
+            i -= 1
+            yield (x[i], None)
+        else:
+            j -= 1
+            yield (None, y[j])
+
+
+def _labels(string: str) -> Labels:
+    """Splits a string into characters with unseparated diacritics.
+
+    Modifiers at the start of the string have nothing to attach to, so each
+    is a label of its own."""
+    mods = build_sym._patterns().mods
+    start = 0
+    while start < len(string) and string[start] in mods:
+        start += 1
+    return list(string[:start]) + build_sym._char_processor(string[start:])
+
+
+def _table_groups(
+    indices: List[int], xs: List[Labels], ys: List[Labels]
+) -> Iterator[List[int]]:
+    """Groups items so that their stacked tables have at most TABLE_CELLS
+    cells, unless a single item needs more."""
+    group: List[int] = []
+    (xdim, ydim) = (0, 0)
+    for b in indices:
+        (x, y) = (max(xdim, len(xs[b])), max(ydim, len(ys[b])))
+        if group and (x + 1) * (len(group) + 1) * (y + 1) > TABLE_CELLS:
+            yield group
+            group = []
+            (x, y) = (len(xs[b]), len(ys[b]))
+        group.append(b)
+        (xdim, ydim) = (x, y)
+    if group:
+        yield group
+
+
+def _score_batch(
+    pairs: List[Tuple[str, str]], confusions: Optional[Counter] = None
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Computes sufficient statistics for LER calculation.
+
+    If `confusions` is given, it is updated with the (gold, hypo) label pairs
+    of an optimal alignment of each example."""
+    gold_labels = [_labels(gold) for (gold, _) in pairs]
+    hypo_labels = [_labels(hypo) for (_, hypo) in pairs]
+    lengths = numpy.array([len(l) for l in gold_labels], dtype=numpy.int64)
+    edits = _edit_distances(gold_labels, hypo_labels)
+    if confusions is None:
+        return (edits, lengths)
+    incorrect = []
+    for (b, (x, y)) in enumerate(zip(gold_labels, hypo_labels)):
+        if edits[b]:
+            incorrect.append(b)
+        else:
+            confusions.update(zip(x, x))
+    # Whole tables, with shape (gold, group, hypo), are only kept to
+    # backtrace the incorrect items, grouped by length so that one long item
+    # does not pad the tables of the others.
+    incorrect.sort(key=lambda b: (len(gold_labels[b]), len(hypo_labels[b])))
+    for group in _table_groups(incorrect, gold_labels, hypo_labels):
+        xs = [gold_labels[b] for b in group]
+        ys = [hypo_labels[b] for b in group]
+        tables = numpy.stack(list(_edit_rows(xs, ys)))
+        for (k, (x, y)) in enumerate(zip(xs, ys)):
+            confusions.update(_edit_operations(tables[:, k, :], x, y))
+    return (edits, lengths)
+
+
+def _write_confusions(confusions: Counter, path: str) -> None:
+    """Writes operation, gold, hypo, count TSV rows, most frequent first."""
+    with open(path, "w") as sink:
+        for ((gold, hypo), count) in confusions.most_common():
+            if gold == hypo:
+                op = "match"
+            elif gold is None:
+                op = "insertion"
+            elif hypo is None:
+                op = "deletion"
             else:
-                c1 = table[i - 1][j]
-                c2 = table[i][j - 1]
-                c3 = table[i - 1][j - 1]
-                table[i][j] = min(c1, c2, c3) + 1
-    return int(table[-1][-1])
-
-
-def _score(gold: str, hypo: str) -> Tuple[int, int]:
-    """Computes sufficient statistics for LER calculation."""
-    gold_labels = list(gold)
-    hypo_labels = list(hypo)
-    edits = _edit_distance(gold_labels, hypo_labels)
-    if edits:
-        logging.warning(
-            "Incorrect prediction:\t%s (predicted: %s)", gold, hypo
+                op = "substitution"
+            print(op, gold or "", hypo or "", count, sep="\t", file=sink)
+
+
+def _bootstrap(
+    edits: numpy.ndarray,
+    lengths: numpy.ndarray,
+    samples: int,
+    confidence: float,
+    seed: int,
+) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    """Computes percentile bootstrap confidence intervals for WER and LER.
+
+    Resamples are drawn in blocks so that the index matrix stays small."""
+    rng = numpy.random.RandomState(seed)
+    size = len(edits)
+    errors = (edits != 0).astype(numpy.float64)
+    wers = numpy.empty(samples)
+    lers = numpy.empty(samples)
+    block = max(1, 10000000 // max(size, 1))
+    for start in range(0, samples, block):
+        stop = min(start + block, samples)
+        indices = rng.randint(0, size, size=(stop - start, size))
+        wers[start:stop] = errors[indices].mean(axis=1)
+        lers[start:stop] = edits[indices].sum(axis=1) / numpy.maximum(
+            lengths[indices].sum(axis=1), 1
         )
-    return (edits, len(gold_labels))
+    alpha = 100 * (1 - confidence) / 2
+    bounds = [alpha, 100 - alpha]
+    return (
+        tuple(numpy.percentile(wers, bounds)),
+        tuple(numpy.percentile(lers, bounds)),
+    )
 
 
 def _tsv_reader(path: str) -> Iterator[Tuple[str, str]]:
@@ -57,6 +226,43 @@ def _tsv_reader(path: str) -> Iterator[Tuple[str, str]]:
             yield (gold, hypo)
 
 
+def _predict(
+    args: argparse.Namespace, sink: Optional[TextIO] = None
+) -> Iterator[Tuple[str, str]]:
+    """Decodes the words of a word/gold TSV filepath with a pool of workers.
+
+    Yields gold and hypothesis pairs in input order as results arrive, also
+    writing word and hypothesis TSV rows to `sink` if given."""
+    # Only decoding needs pynini, so plain TSV scoring runs without it.
+    import rewrite
+
+    # Pairs read but not yet decoded, in input order.
+    pending = collections.deque()
+
+    def _words() -> Iterator[str]:
+        for (word, gold) in _tsv_reader(args.tsv_path):
+            pending.append((word, gold))
+            yield word
+
+    with rewrite.G2PModel(
+        args.fst_path,
+        args.token_type,
+        args.fst_type,
+        workers=args.workers,
+        batch_size=args.decode_batch_size,
+        window_size=args.window_size,
+        max_windows=args.max_windows,
+    ) as model:
+        for hypo in model.transcribe_stream(_words()):
+            (word, gold) = pending.popleft()
+            if model.symbols:
+                # Symbols are written space-separated.
+                hypo = hypo.replace(" ", "")
+            if sink is not None:
+                sink.write(f"{word}\t{hypo}\n")
+            yield (gold, hypo)
+
+
 def main(args: argparse.Namespace) -> None:
     # Word-level measures.
     correct = 0
@@ -64,23 +270,146 @@ def main(args: argparse.Namespace) -> None:
     # Label-level measures.
     total_edits = 0
     total_length = 0
-    # Since the edit distance algorithm is quadratic, let's do this with
-    # multiprocessing.
-    with multiprocessing.Pool() as pool:
-        gen = pool.starmap(_score, _tsv_reader(args.tsv_path))
-        for (edits, length) in gen:
-            if edits == 0:
-                correct += 1
-            else:
-                incorrect += 1
-            total_edits += edits
-            total_length += length
+    # Per-item statistics, kept only for the bootstrap.
+    all_edits: List[numpy.ndarray] = []
+    all_lengths: List[numpy.ndarray] = []
+    confusions = collections.Counter() if args.confusions_path else None
+    with contextlib.ExitStack() as stack:
+        if args.fst_path:
+            hypo_sink = None
+            if args.hypo_path:
+                hypo_sink = stack.enter_context(open(args.hypo_path, "w"))
+            pairs = _predict(args, hypo_sink)
+        else:
+            pairs = _tsv_reader(args.tsv_path)
+        sink = None
+        if args.errors_path:
+            sink = stack.enter_context(open(args.errors_path, "w"))
+        while True:
+            batch = list(itertools.islice(pairs, args.batch_size))
+            if not batch:
+                break
+            (edits, lengths) = _score_batch(batch, confusions)
+            errors = int(numpy.count_nonzero(edits))
+            correct += len(batch) - errors
+            incorrect += errors
+            total_edits += int(edits.sum())
+            total_length += int(lengths.sum())
+            if sink is not None:
+                sink.writelines(
+                    f"{gold}\t{hypo}\t{e}\n"
+                    for ((gold, hypo), e) in zip(batch, edits)
+                    if e
+                )
+            if args.bootstrap_samples:
+                all_edits.append(edits.astype(numpy.int32))
+                all_lengths.append(lengths.astype(numpy.int32))
     logging.info("WER:\t%.4f", incorrect / (correct + incorrect))
     logging.info("LER:\t%.4f", total_edits / total_length)
+    if confusions is not None:
+        _write_confusions(confusions, args.confusions_path)
+    if args.bootstrap_samples:
+        (wer_ci, ler_ci) = _bootstrap(
+            numpy.concatenate(all_edits),
+            numpy.concatenate(all_lengths),
+            args.bootstrap_samples,
+            args.confidence,
+            args.seed,
+        )
+        logging.info(
+            "WER %.0f%% CI:\t%.4f-%.4f", 100 * args.confidence, *wer_ci
+        )
+        logging.info(
+            "LER %.0f%% CI:\t%.4f-%.4f", 100 * args.confidence, *ler_ci
+        )
 
 
 if __name__ == "__main__":
     logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
     parser = argparse.ArgumentParser(description="Evaluates sequence model")
-    parser.add_argument("tsv_path", help="path to gold/hypo TSV file")
+    parser.add_argument(
+        "tsv_path",
+        help="path to gold/hypo TSV file, or word/gold TSV file with "
+        "--fst_path",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4096,
+        help="number of pairs scored per kernel call (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--errors_path",
+        help="path to write incorrect predictions to, as gold, hypo, edits "
+        "TSV rows",
+    )
+    parser.add_argument(
+        "--confusions_path",
+        help="path to write label confusion counts to, as operation, gold, "
+        "hypo, count TSV rows",
+    )
+    parser.add_argument(
+        "--bootstrap_samples",
+        type=int,
+        default=0,
+        help="number of bootstrap resamples for confidence intervals "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="confidence level of the intervals (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed for bootstrap resampling (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--fst_path",
+        help="path to rewrite FST or model bundle to decode the words with",
+    )
+    parser.add_argument(
+        "--token_type",
+        default="utf8",
+        help="token type of the model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--fst_type",
+        default="vector",
+        # As bundle.FST_TYPES, which cannot be imported without pynini.
+        choices=("vector", "const"),
+        help="FST type the model is prepared as for decoding; ignored for "
+        "bundles (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hypo_path",
+        help="path to write the hypotheses to, as word, hypo TSV rows",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of decoding worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--decode_batch_size",
+        type=int,
+        default=128,
+        help="number of words per decoding task (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--window_size",
+        type=int,
+        default=8192,
+        help="number of words read and length-sorted at once "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_windows",
+        type=int,
+        default=2,
+        help="maximum number of windows in flight (default: %(default)s)",
+    )
     main(parser.parse_args())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Tests for evaluate.py."""
+
+import collections
+import random
+import unittest
+
+import evaluate
+
+
+def _reference(x, y):
+    """Edit distance by the textbook dynamic program."""
+    row = list(range(len(y) + 1))
+    for i in range(1, len(x) + 1):
+        previous = row
+        row = [i]
+        for j in range(1, len(y) + 1):
+            row.append(
+                min(
+                    previous[j] + 1,
+                    row[j - 1] + 1,
+                    previous[j - 1] + (x[i - 1] != y[j - 1]),
+                )
+            )
+    return row[-1]
+
+
+class EditDistanceTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.pairs = [
+            (
+                "".join(rng.choice("abc") for _ in range(rng.randint(0, 12))),
+                "".join(rng.choice("abc") for _ in range(rng.randint(0, 12))),
+            )
+            for _ in range(500)
+        ]
+        self.pairs += [
+            ("", ""),
+            ("", "abc"),
+            ("abc", ""),
+            ("a" * 300, "b" * 300),
+            ("", "x" * 400),
+            ("ab" * 200, "ba" * 150),
+        ]
+
+    def test_edit_distances_match_reference(self):
+        xs = [list(x) for (x, _) in self.pairs]
+        ys = [list(y) for (_, y) in self.pairs]
+        distances = evaluate._edit_distances(xs, ys)
+        self.assertEqual(
+            distances.tolist(),
+            [_reference(x, y) for (x, y) in self.pairs],
+        )
+
+    def test_long_distances_do_not_wrap(self):
+        self.assertEqual(
+            evaluate._edit_distance(["a"] * 300, ["b"] * 300), 300
+        )
+        self.assertEqual(evaluate._edit_distance([], ["x"] * 400), 400)
+
+    def test_confusions_account_for_edits(self):
+        for cells in (evaluate.TABLE_CELLS, 100):
+            confusions = collections.Counter()
+            (edits, lengths) = self._score(cells, confusions)
+            errors = sum(
+                count
+                for ((gold, hypo), count) in confusions.items()
+                if gold != hypo
+            )
+            self.assertEqual(errors, int(edits.sum()))
+            # Every gold label is either matched, substituted or deleted.
+            self.assertEqual(
+                sum(
+                    count
+                    for ((gold, _), count) in confusions.items()
+                    if gold is not None
+                ),
+                int(lengths.sum()),
+            )
+
+    def _score(self, cells, confusions):
+        saved = evaluate.TABLE_CELLS
+        evaluate.TABLE_CELLS = cells
+        try:
+            return evaluate._score_batch(self.pairs, confusions)
+        finally:
+            evaluate.TABLE_CELLS = saved
+
+    def test_leading_modifier_is_a_label(self):
+        (edits, lengths) = evaluate._score_batch([("abc", "ːabc")])
+        self.assertEqual(edits.tolist(), [1])
+        self.assertEqual(lengths.tolist(), [3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Generates load against a running serve.py server.
+
+Opens a number of concurrent connections, each sending requests of words
+sampled from a word list back to back, and reports throughput and request
+latency, followed by the server metrics."""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+from typing import List
+
+import client
+import common
+
+
+async def _connection(
+    args: argparse.Namespace,
+    words: List[str],
+    seed: int,
+    deadline: float,
+    latency: common._Histogram,
+) -> int:
+    """Sends requests until the deadline; returns the number of words."""
+    rng = random.Random(seed)
+    (reader, writer) = await client._open_connection(
+        args.socket_path, args.port
+    )
+    sent = 0
+    while time.time() < deadline:
+        request = {"words": rng.choices(words, k=args.words_per_request)}
+        started = time.time()
+        writer.write(json.dumps(request).encode("utf8") + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        latency.add(time.time() - started)
+        sent += args.words_per_request
+    writer.close()
+    return sent
+
+
+async def _run(args: argparse.Namespace, words: List[str]) -> None:
+    latency = common._Histogram()
+    started = time.time()
+    deadline = started + args.duration
+    counts = await asyncio.gather(
+        *(
+            _connection(args, words, args.seed + n, deadline, latency)
+            for n in range(args.connections)
+        )
+    )
+    elapsed = time.time() - started
+    logging.info(
+        "%d requests, %d words in %.2f s (%.0f words/s)",
+        latency.n,
+        sum(counts),
+        elapsed,
+        sum(counts) / elapsed,
+    )
+    logging.info(
+        "Request latency:\tp50 %.3f ms\tp95 %.3f ms\tp99 %.3f ms",
+        *(1000 * latency.percentile(q) for q in common.PERCENTILES),
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    words = list(common._reader(args.word_path))
+    asyncio.get_event_loop().run_until_complete(_run(args, words))
+    with client.Client(args.socket_path, args.port) as metrics_client:
+        logging.info(
+            "Server metrics:\n%s",
+            json.dumps(metrics_client.metrics(), indent=2),
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    client._add_address_arguments(parser)
+    parser.add_argument(
+        "--word_path",
+        required=True,
+        help="path to file of words to sample requests from",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=16,
+        help="number of concurrent connections (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--words_per_request",
+        type=int,
+        default=1,
+        help="number of words per request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10,
+        help="seconds to generate load for (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed (default: %(default)s)",
+    )
+    main(parser.parse_args())
@@ -4,67 +4,1002 @@
 This script assumes the input is provided one example per line."""
 
 import argparse
+import asyncio
+import collections
+import cProfile
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import math
 import multiprocessing
+import multiprocessing.pool
+import pstats
+import random
+import sqlite3
+import sys
+import time
 
-from typing import Iterator, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
+import build_lexicon
 import build_sym
+import bundle
+import common
 import pynini
+import pywrapfst
+
+
+def _decode(
+    labels: List[int], token_type: Union[str, pynini.SymbolTable]
+) -> str:
+    """Turns output labels back into a string."""
+    if token_type == "byte":
+        return bytes(labels).decode("utf8")
+    elif token_type == "utf8":
+        return "".join(chr(label) for label in labels)
+    return " ".join(token_type.find(label) for label in labels)
+
+
+def _stringify(
+    path: pywrapfst.Fst, token_type: Union[str, pynini.SymbolTable]
+) -> str:
+    """Reads the output string off a single-path FST."""
+    labels = []
+    state = path.start()
+    arcs = list(path.arcs(state))
+    while arcs:
+        (arc,) = arcs
+        if arc.olabel:
+            labels.append(arc.olabel)
+        arcs = list(path.arcs(arc.nextstate))
+    return _decode(labels, token_type)
+
+
+def _paths(
+    fst: pywrapfst.Fst, token_type: Union[str, pynini.SymbolTable]
+) -> List[Tuple[str, float]]:
+    """Lists the output strings and costs of an acyclic FST, best first."""
+    paths = []
+    stack = [(fst.start(), [], 0.0)]
+    while stack:
+        (state, labels, cost) = stack.pop()
+        final = float(fst.final(state).to_string())
+        if final != float("inf"):
+            paths.append((_decode(labels, token_type), cost + final))
+        for arc in fst.arcs(state):
+            stack.append(
+                (
+                    arc.nextstate,
+                    labels + [arc.olabel] if arc.olabel else labels,
+                    cost + float(arc.weight.to_string()),
+                )
+            )
+    paths.sort(key=lambda path: path[1])
+    return paths
+
+
+def _format_nbest(i: str, paths: List[Tuple[str, float]]) -> str:
+    """Formats n-best paths as word, rank, pronunciation, weight rows."""
+    return "\n".join(
+        f"{i}\t{rank}\t{o}\t{cost:.4f}"
+        for (rank, (o, cost)) in enumerate(paths, 1)
+    )
+
+
+class _Timing(NamedTuple):
+    """Latency of each step of a rewrite, in seconds, and lattice size."""
+
+    word: str
+    compile: float
+    compose: float
+    search: float
+    states: int
+    arcs: int
+    failed: bool
+
+    @property
+    def total(self) -> float:
+        return self.compile + self.compose + self.search
+
+
+class _Stats:
+    """Aggregates rewrite timings across workers.
+
+    Keeps a latency histogram per step, lattice sizes, the number of
+    composition failures and the `slowest` slowest inputs."""
+
+    STEPS = ("compile", "compose", "search", "total")
+    PERCENTILES = common.PERCENTILES
+
+    def __init__(self, slowest: int = 10):
+        self.histograms = {step: common._Histogram() for step in self.STEPS}
+        self.slowest = slowest
+        # A min-heap, so the fastest of the slowest inputs is evicted first.
+        self.heap: List[Tuple[float, str, _Timing]] = []
+        self.words = 0
+        self.failures = 0
+        self.states = 0
+        self.arcs = 0
+        self.max_states = 0
+        self.max_arcs = 0
+
+    def add(self, timings: Iterable[_Timing]) -> None:
+        for timing in timings:
+            self.words += 1
+            self.failures += timing.failed
+            for step in self.STEPS:
+                self.histograms[step].add(getattr(timing, step))
+            self.states += timing.states
+            self.arcs += timing.arcs
+            self.max_states = max(self.max_states, timing.states)
+            self.max_arcs = max(self.max_arcs, timing.arcs)
+            entry = (timing.total, timing.word, timing)
+            if len(self.heap) < self.slowest:
+                heapq.heappush(self.heap, entry)
+            else:
+                heapq.heappushpop(self.heap, entry)
+
+    def report(self) -> Dict[str, Any]:
+        """Summarizes the timings as a JSON-serializable dictionary."""
+        steps = {}
+        for (step, histogram) in self.histograms.items():
+            summary = {
+                f"p{q}": histogram.percentile(q) for q in self.PERCENTILES
+            }
+            summary["mean"] = histogram.sum / histogram.n if histogram.n else 0
+            summary["histogram"] = histogram.buckets()
+            steps[step] = summary
+        return {
+            "words": self.words,
+            "failures": self.failures,
+            "lattice": {
+                "mean_states": self.states / self.words if self.words else 0,
+                "mean_arcs": self.arcs / self.words if self.words else 0,
+                "max_states": self.max_states,
+                "max_arcs": self.max_arcs,
+            },
+            "steps": steps,
+            "slowest": [
+                dict(timing._asdict(), total=timing.total)
+                for (_, _, timing) in sorted(self.heap, reverse=True)
+            ],
+        }
+
+    def log(self) -> None:
+        logging.info(
+            "Decoded %d words, %d composition failures",
+            self.words,
+            self.failures,
+        )
+        for (step, histogram) in self.histograms.items():
+            logging.info(
+                "%s latency:\tp50 %.3f ms\tp95 %.3f ms\tp99 %.3f ms",
+                step,
+                *(1000 * histogram.percentile(q) for q in self.PERCENTILES),
+            )
+        for (total, word, timing) in sorted(self.heap, reverse=True):
+            logging.info(
+                "Slow input:\t%s\t%.3f ms\t%d states\t%d arcs",
+                word,
+                1000 * total,
+                timing.states,
+                timing.arcs,
+            )
+
+
+class _Profile:
+    """Wraps collected profiler stats so that pstats can load them."""
+
+    def __init__(self, stats: Dict[Any, Any]):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
 
 
 class _Rewriter:
-    """Helper object for rewriting."""
+    """Helper object for rewriting.
+
+    With `nshortest` greater than one, or a `weight_threshold`, rewrites are
+    n-best lists formatted as TSV rows rather than single strings."""
 
     def __init__(
-        self, fst: pynini.Fst, token_type: Union[str, pynini.SymbolTable]
+        self,
+        fst: pywrapfst.Fst,
+        token_type: Union[str, pynini.SymbolTable],
+        lexicon: Optional[build_lexicon.Lexicon] = None,
+        lexicon_override: bool = True,
+        nshortest: int = 1,
+        weight_threshold: Optional[float] = None,
     ):
         self.fst = fst
         self.token_type = token_type
+        self.lexicon = lexicon or {}
+        self.lexicon_override = lexicon_override
+        self.nshortest = nshortest
+        self.weight_threshold = weight_threshold
 
     @classmethod
-    def from_args(cls, fst_path: str, token_type: str):
-        fst = pynini.Fst.read(fst_path)
-        if token_type not in {"byte", "utf8"}:
-            token_type = pynini.SymbolTable.read_text(token_type)
-        return cls(fst, token_type)
+    def from_args(
+        cls,
+        fst_path: str,
+        token_type: str,
+        fst_type: str = "vector",
+        lexicon_path: Optional[str] = None,
+        lexicon_override: bool = True,
+        nshortest: int = 1,
+        weight_threshold: Optional[float] = None,
+    ):
+        if bundle._is_bundle(fst_path):
+            # Bundles carry their own token type and are already prepared.
+            (fst, token_type, _) = bundle._read(fst_path)
+        else:
+            fst = bundle._prepare(pynini.Fst.read(fst_path), fst_type)
+            if token_type not in {"byte", "utf8"}:
+                token_type = pynini.SymbolTable.read_text(token_type)
+        lexicon = build_lexicon._read(lexicon_path) if lexicon_path else None
+        return cls(
+            fst,
+            token_type,
+            lexicon,
+            lexicon_override,
+            nshortest,
+            weight_threshold,
+        )
+
+    @property
+    def nbest(self) -> bool:
+        return self.nshortest > 1 or self.weight_threshold is not None
+
+    def _nbest_rows(self, i: str, paths: List[Tuple[str, float]]) -> str:
+        # Symbol table input is split into space-separated symbols, but the
+        # word column holds the word itself.
+        if not isinstance(self.token_type, str):
+            i = i.replace(" ", "")
+        return _format_nbest(i, paths)
+
+    def lookup(self, i: str) -> Optional[str]:
+        """Returns the lexicon entry to use in place of the model, if any."""
+        if not self.lexicon_override:
+            return None
+        hit = self.lexicon.get(i)
+        if hit is not None and self.nbest:
+            return self._nbest_rows(i, [(hit, 0.0)])
+        return hit
 
     def rewrite(self, i: str) -> str:
-        lattice = pynini.acceptor(i, token_type=self.token_type) @ self.fst
+        hit = self.lookup(i)
+        if hit is not None:
+            return hit
+        return self.timed_rewrite(i)[0]
+
+    def timed_rewrite(
+        self, i: str, sizes: bool = False
+    ) -> Tuple[str, _Timing]:
+        """Rewrites with the model, timing each step.
+
+        The lattice is only measured if `sizes` is set, since counting its
+        arcs takes time of its own."""
+        started = time.perf_counter()
+        acceptor = pynini.acceptor(i, token_type=self.token_type)
+        compiled = time.perf_counter()
+        if isinstance(self.fst, pynini.Fst):
+            lattice = acceptor @ self.fst
+        else:
+            # Prepared models are immutable, so they are composed with the
+            # generic operation, which picks up their matchers.
+            lattice = pywrapfst.compose(acceptor, self.fst)
+        composed = time.perf_counter()
+        (states, arcs) = (0, 0)
+        if sizes:
+            states = lattice.num_states()
+            arcs = sum(lattice.num_arcs(state) for state in lattice.states())
+        # Sizing is not charged to any step.
+        sized = time.perf_counter()
         if lattice.start() == pynini.NO_STATE_ID:
             logging.error("Composition failure: %s", i)
-            return "<composition failure>"
-        return pynini.shortestpath(lattice).stringify(
-            token_type=self.token_type
+            o = "<composition failure>"
+            if self.nbest:
+                o = self._nbest_rows(i, [(o, math.inf)])
+            return (
+                o,
+                _Timing(
+                    i,
+                    compiled - started,
+                    composed - compiled,
+                    0.0,
+                    states,
+                    arcs,
+                    True,
+                ),
+            )
+        if self.nbest:
+            o = self._nbest_rows(i, self._nbest(lattice))
+        elif isinstance(self.fst, pynini.Fst):
+            o = pynini.shortestpath(lattice).stringify(
+                token_type=self.token_type
+            )
+        else:
+            o = _stringify(pywrapfst.shortestpath(lattice), self.token_type)
+        searched = time.perf_counter()
+        return (
+            o,
+            _Timing(
+                i,
+                compiled - started,
+                composed - compiled,
+                searched - sized,
+                states,
+                arcs,
+                False,
+            ),
         )
 
+    def _nbest(self, lattice: pywrapfst.Fst) -> List[Tuple[str, float]]:
+        # Distinct pronunciations are needed, so alignments are collapsed
+        # before the search; the weight threshold prunes paths inside it.
+        lattice.project(True)
+        lattice.rmepsilon()
+        return _paths(
+            pywrapfst.shortestpath(
+                lattice,
+                nshortest=self.nshortest,
+                unique=True,
+                weight=self.weight_threshold,
+            ),
+            self.token_type,
+        )
 
-def _reader(path: str, token_type: str) -> Iterator[str]:
-    """Reads strings from a single-column filepath."""
-    with open(path, "r") as source:
-        for line in source:
-            token = line.rstrip()
-            if token_type not in {"byte", "utf8"}:
-                yield " ".join(build_sym._char_processor(token))
+
+def _fingerprint(fst_path: str, token_type: str) -> str:
+    """Hashes the model and token type, so retrained models get new keys."""
+    if bundle._is_bundle(fst_path):
+        # Bundles record a hash of their model and their token type.
+        header = bundle._read_header(fst_path)
+        return f"{header['sha256']}:{header['token_type']}"
+    digest = hashlib.sha256()
+    paths = [fst_path]
+    if token_type not in {"byte", "utf8"}:
+        paths.append(token_type)
+    else:
+        digest.update(token_type.encode("utf8"))
+    for path in paths:
+        with open(path, "rb") as source:
+            for block in iter(lambda: source.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class _ResultCache:
+    """Memoizes rewrites in an in-process LRU, optionally backed by SQLite.
+
+    Entries are keyed by the model fingerprint and the tokenized input, so
+    entries written for a different model or token type are never hit."""
+
+    def __init__(
+        self, fingerprint: str, max_size: int, path: Optional[str] = None
+    ):
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.lru: Dict[str, str] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS rewrites "
+                "(model TEXT, input TEXT, output TEXT, "
+                "PRIMARY KEY (model, input))"
+            )
+
+    def _remember(self, i: str, o: str) -> None:
+        self.lru[i] = o
+        self.lru.move_to_end(i)
+        while len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+
+    def get(self, i: str) -> Optional[str]:
+        o = self.lru.get(i)
+        if o is not None:
+            self.lru.move_to_end(i)
+        elif self.db is not None:
+            row = self.db.execute(
+                "SELECT output FROM rewrites WHERE model = ? AND input = ?",
+                (self.fingerprint, i),
+            ).fetchone()
+            if row is not None:
+                o = row[0]
+                self._remember(i, o)
+        if o is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return o
+
+    def update(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        pairs = list(pairs)
+        for (i, o) in pairs:
+            self._remember(i, o)
+        if self.db is not None:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO rewrites VALUES (?, ?, ?)",
+                    ((self.fingerprint, i, o) for (i, o) in pairs),
+                )
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+
+
+# Per-process rewriter; set once by _init_worker so that tasks only carry
+# the words themselves rather than a pickled copy of the model.
+_rewriter: Optional[_Rewriter] = None
+# Options the per-process rewriter was loaded with.
+_options: Optional[Dict[str, Any]] = None
+# Fraction of words profiled by each worker.
+_profile_rate = 0.0
+
+
+def _init_worker(options: Dict[str, Any], profile_rate: float = 0.0) -> None:
+    """Loads the model once per worker process."""
+    global _rewriter
+    global _options
+    global _profile_rate
+    _profile_rate = profile_rate
+    # Under the fork start method the parent's rewriter is inherited as is,
+    # unless the parent has since loaded another model.
+    if _rewriter is None or _options != options:
+        _rewriter = _Rewriter.from_args(**options)
+        _options = options
+
+
+def _rewrite_batch(batch: List[str]) -> List[str]:
+    """Rewrites a batch of strings with the per-process rewriter."""
+    return [_rewriter.rewrite(i) for i in batch]
+
+
+def _timed_rewrite_batch(
+    batch: List[str],
+) -> Tuple[List[str], List[_Timing], Optional[Dict[Any, Any]]]:
+    """Rewrites a batch of strings, timing each and profiling a sample.
+
+    Returns the rewrites, their timings and the profiler stats of the
+    sampled words, if any were sampled."""
+    outputs = []
+    timings = []
+    profiler = None
+    for i in batch:
+        if _profile_rate and random.random() < _profile_rate:
+            if profiler is None:
+                profiler = cProfile.Profile()
+            profiler.enable()
+            (o, timing) = _rewriter.timed_rewrite(i, sizes=True)
+            profiler.disable()
+        else:
+            (o, timing) = _rewriter.timed_rewrite(i, sizes=True)
+        outputs.append(o)
+        timings.append(timing)
+    if profiler is None:
+        return (outputs, timings, None)
+    profiler.create_stats()
+    return (outputs, timings, profiler.stats)
+
+
+def _length_sorted_batches(
+    window: List[str], size: int
+) -> Tuple[List[int], List[List[str]]]:
+    """Groups a window of strings into batches of similar length.
+
+    Returns the permutation applied along with the batches so that the
+    results can be put back in input order."""
+    order = sorted(range(len(window)), key=lambda n: len(window[n]))
+    return (order, list(common._batcher((window[n] for n in order), size)))
+
+
+def _unpermute(order: List[int], batches: List[List[str]]) -> List[str]:
+    """Inverts the permutation applied by _length_sorted_batches."""
+    results = [None] * len(order)
+    for (n, result) in zip(order, itertools.chain.from_iterable(batches)):
+        results[n] = result
+    return results
+
+
+# A window of strings submitted to the workers: its rewrites so far, the
+# positions of each string left to the workers, the permutation applied to
+# them and the pending result, or None if nothing was left to them.
+_Window = Tuple[
+    List[Optional[str]],
+    Dict[str, List[int]],
+    List[int],
+    Optional[multiprocessing.pool.AsyncResult],
+]
+
+
+def _submit_window(
+    pool: multiprocessing.pool.Pool,
+    window: List[str],
+    batch_size: int,
+    chunksize: int,
+    lookup: Callable[[str], Optional[str]],
+    task: Callable[[List[str]], Any] = _rewrite_batch,
+    callback: Optional[Callable[[List[Any]], None]] = None,
+    error_callback: Optional[Callable[[BaseException], None]] = None,
+) -> _Window:
+    """Sends the strings of a window that `lookup` does not resolve to the
+    workers, each only once and in batches of similar length."""
+    hypos = [lookup(i) for i in window]
+    # Maps each string still to be rewritten to its positions.
+    todo: Dict[str, List[int]] = {}
+    for (n, i) in enumerate(window):
+        if hypos[n] is None:
+            todo.setdefault(i, []).append(n)
+    if not todo:
+        # The pool never calls back for an empty map.
+        return (hypos, todo, [], None)
+    (order, batches) = _length_sorted_batches(list(todo), batch_size)
+    result = pool.map_async(
+        task,
+        batches,
+        chunksize=chunksize,
+        callback=callback,
+        error_callback=error_callback,
+    )
+    return (hypos, todo, order, result)
+
+
+def _complete_window(
+    submitted: _Window,
+    outputs: List[Any],
+    collect: Optional[Callable[[List[Any]], List[List[str]]]] = None,
+    store: Optional[Callable[[List[Tuple[str, str]]], None]] = None,
+) -> List[str]:
+    """Fills in the rewrites of a window from the outputs of its batches.
+
+    If given, `collect` turns the outputs of the task into batches of
+    rewrites, and `store` is passed the rewrites computed by the workers."""
+    (hypos, todo, order, _) = submitted
+    if collect is not None:
+        outputs = collect(outputs)
+    results = list(zip(todo, _unpermute(order, outputs)))
+    for (i, hypo) in results:
+        for n in todo[i]:
+            hypos[n] = hypo
+    if store is not None:
+        store(results)
+    return hypos
+
+
+def _rewrite_windows(
+    pool: multiprocessing.pool.Pool,
+    windows: Iterable[List[str]],
+    batch_size: int,
+    chunksize: int,
+    max_windows: int,
+    lookup: Callable[[str], Optional[str]],
+    task: Callable[[List[str]], Any] = _rewrite_batch,
+    collect: Optional[Callable[[List[Any]], List[List[str]]]] = None,
+    store: Optional[Callable[[List[Tuple[str, str]]], None]] = None,
+) -> Iterator[Tuple[List[str], List[str]]]:
+    """Rewrites windows of strings with a pool of workers.
+
+    Yields each window with its rewrites, in input order. At most
+    `max_windows` windows are in flight at once, so peak memory does not
+    depend on the size of the input."""
+    pending = collections.deque()
+
+    def _flush() -> Tuple[List[str], List[str]]:
+        (window, submitted) = pending.popleft()
+        outputs = [] if submitted[-1] is None else submitted[-1].get()
+        return (window, _complete_window(submitted, outputs, collect, store))
+
+    for window in windows:
+        pending.append(
+            (
+                window,
+                _submit_window(
+                    pool, window, batch_size, chunksize, lookup, task
+                ),
+            )
+        )
+        if len(pending) >= max_windows:
+            yield _flush()
+    while pending:
+        yield _flush()
+
+
+class G2PModel:
+    """Grapheme-to-phoneme model with a managed pool of worker processes.
+
+    The model is loaded once, in this process, and the workers inherit it.
+    Words are given untokenized; with a symbol table token type, they are
+    split into characters and pronunciations are space-separated symbols.
+    With `nshortest` greater than one, or a `weight_threshold`, each
+    pronunciation is an n-best list formatted as TSV rows.
+
+    Words in the lexicon at `lexicon_path`, or memoized by a `cache_size` or
+    `cache_path` cache, are resolved without the workers. If `stats` is set,
+    the other words are timed into `stats`; with a `profile_rate`, a sample
+    of them is profiled into `profile`.
+
+    Use as a context manager, or call close(), to shut the pool down. Models
+    are not thread-safe, but asynchronous calls from one event loop may
+    overlap."""
+
+    def __init__(
+        self,
+        fst_path: str,
+        token_type: str = "utf8",
+        fst_type: str = "vector",
+        lexicon_path: Optional[str] = None,
+        lexicon_override: bool = True,
+        nshortest: int = 1,
+        weight_threshold: Optional[float] = None,
+        workers: Optional[int] = None,
+        batch_size: int = 128,
+        chunksize: int = 1,
+        window_size: int = 8192,
+        max_windows: int = 2,
+        cache_size: int = 0,
+        cache_path: Optional[str] = None,
+        stats: bool = False,
+        slowest: int = 10,
+        profile_rate: float = 0.0,
+    ):
+        global _rewriter
+        global _options
+        self.options = {
+            "fst_path": fst_path,
+            "token_type": token_type,
+            "fst_type": fst_type,
+            "nshortest": nshortest,
+            "weight_threshold": weight_threshold,
+        }
+        self.rewriter = _Rewriter.from_args(
+            lexicon_path=lexicon_path,
+            lexicon_override=lexicon_override,
+            **self.options,
+        )
+        self.fst_type = fst_type
+        if bundle._is_bundle(fst_path):
+            self.fst_type = bundle._read_header(fst_path)["fst_type"]
+        self.symbols = not isinstance(self.rewriter.token_type, str)
+        self.batch_size = batch_size
+        self.chunksize = chunksize
+        self.window_size = window_size
+        self.max_windows = max_windows
+        self.cache = None
+        if cache_size or cache_path:
+            # N-best output depends on the search options too.
+            fingerprint = _fingerprint(fst_path, token_type)
+            if self.rewriter.nbest:
+                fingerprint += f":{nshortest}:{weight_threshold}"
+            self.cache = _ResultCache(fingerprint, cache_size, cache_path)
+        self.stats = _Stats(slowest) if stats else None
+        self.profile: Optional[pstats.Stats] = None
+        self.timed = stats or bool(profile_rate)
+        self.words = 0
+        self.lexicon_hits = 0
+        # Creating the pool with the model loaded lets forked workers share
+        # its pages instead of each re-reading it.
+        _rewriter = self.rewriter
+        _options = self.options
+        self.pool = multiprocessing.Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(self.options, profile_rate),
+        )
+
+    def __enter__(self) -> "G2PModel":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shuts down the workers and closes the cache."""
+        self.pool.close()
+        self.pool.join()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _tokenize(self, word: str) -> str:
+        self.words += 1
+        if self.symbols:
+            word = build_sym._tokenize(word)
+        self.lexicon_hits += word in self.rewriter.lexicon
+        return word
+
+    # Lexicon and cache hits are resolved here, so workers never need the
+    # lexicon themselves.
+    def _lookup(self, i: str) -> Optional[str]:
+        hypo = self.rewriter.lookup(i)
+        if hypo is None and self.cache is not None:
+            hypo = self.cache.get(i)
+        return hypo
+
+    def _collect(self, outputs: List[Any]) -> List[List[str]]:
+        for (_, timings, profiled) in outputs:
+            if self.stats is not None:
+                self.stats.add(timings)
+            if profiled is None:
+                continue
+            if self.profile is None:
+                self.profile = pstats.Stats(
+                    _Profile(profiled), stream=sys.stderr
+                )
             else:
-                yield token
+                self.profile.add(_Profile(profiled))
+        return [output for (output, _, _) in outputs]
+
+    def _hooks(self) -> Dict[str, Any]:
+        return {
+            "task": _timed_rewrite_batch if self.timed else _rewrite_batch,
+            "collect": self._collect if self.timed else None,
+            "store": self.cache.update if self.cache is not None else None,
+        }
+
+    def _windows(self, words: Iterable[str]) -> Iterator[List[str]]:
+        """Transcribes words, yielding windows of pronunciations."""
+        hooks = self._hooks()
+        for (_, hypos) in _rewrite_windows(
+            self.pool,
+            common._batcher(map(self._tokenize, words), self.window_size),
+            self.batch_size,
+            self.chunksize,
+            self.max_windows,
+            self._lookup,
+            hooks["task"],
+            hooks["collect"],
+            hooks["store"],
+        ):
+            yield hypos
+
+    def transcribe(self, word: str) -> str:
+        """Transcribes a word."""
+        return self.transcribe_batch([word])[0]
+
+    def transcribe_stream(self, words: Iterable[str]) -> Iterator[str]:
+        """Transcribes words lazily, in input order, in bounded memory."""
+        return itertools.chain.from_iterable(self._windows(words))
+
+    def transcribe_batch(self, words: Iterable[str]) -> List[str]:
+        """Transcribes words, in input order."""
+        return list(self.transcribe_stream(words))
+
+    async def transcribe_batch_async(self, words: Iterable[str]) -> List[str]:
+        """Transcribes words, in input order, without blocking the loop.
+
+        The workers signal completion through the event loop, so no thread
+        waits on them."""
+        loop = asyncio.get_event_loop()
+        hooks = self._hooks()
+        pending = []
+        for window in common._batcher(
+            map(self._tokenize, words), self.window_size
+        ):
+            future = loop.create_future()
+            submitted = _submit_window(
+                self.pool,
+                window,
+                self.batch_size,
+                self.chunksize,
+                self._lookup,
+                hooks["task"],
+                functools.partial(
+                    loop.call_soon_threadsafe, _set_result, future
+                ),
+                functools.partial(
+                    loop.call_soon_threadsafe, _set_exception, future
+                ),
+            )
+            pending.append((submitted, future))
+        hypos = []
+        for (submitted, future) in pending:
+            outputs = [] if submitted[-1] is None else await future
+            hypos.extend(
+                _complete_window(
+                    submitted, outputs, hooks["collect"], hooks["store"]
+                )
+            )
+        return hypos
+
+
+def _set_result(future: asyncio.Future, result: Any) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, error: BaseException) -> None:
+    if not future.done():
+        future.set_exception(error)
 
 
 def main(args: argparse.Namespace) -> None:
-    rewriter = _Rewriter.from_args(args.fst_path, args.token_type)
-    with multiprocessing.Pool() as pool:
-        for line in pool.map(rewriter.rewrite, _reader(args.word_path, args.token_type)):
-            print(line)
+    with G2PModel(
+        args.fst_path,
+        args.token_type,
+        args.fst_type,
+        args.lexicon_path,
+        args.lexicon_override,
+        args.nshortest,
+        args.weight_threshold,
+        args.workers,
+        args.batch_size,
+        args.chunksize,
+        args.window_size,
+        args.max_windows,
+        args.cache_size,
+        args.cache_path,
+        args.stats or bool(args.stats_path),
+        args.slowest,
+        args.profile_rate if args.profile_path else 0.0,
+    ) as model:
+        logging.info("Decoding with %s model FST", model.fst_type)
+        # Results are written as soon as the oldest window completes.
+        for hypos in model._windows(common._reader(args.word_path)):
+            for line in hypos:
+                print(line)
+            sys.stdout.flush()
+    if args.lexicon_path:
+        logging.info(
+            "Lexicon hits:\t%d/%d (%.2f%%)",
+            model.lexicon_hits,
+            model.words,
+            100 * model.lexicon_hits / model.words if model.words else 0,
+        )
+    if model.cache is not None:
+        lookups = model.cache.hits + model.cache.misses
+        logging.info(
+            "Cache hits:\t%d/%d (%.2f%%)",
+            model.cache.hits,
+            lookups,
+            100 * model.cache.hits / lookups if lookups else 0,
+        )
+    if model.stats is not None:
+        model.stats.log()
+        if args.stats_path:
+            with open(args.stats_path, "w") as sink:
+                json.dump(model.stats.report(), sink, indent=2)
+    if args.profile_path:
+        if model.profile is None:
+            logging.info("No words were sampled for profiling")
+        else:
+            model.profile.dump_stats(args.profile_path)
+            logging.info("Profile written to %s", args.profile_path)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
-        "--word_path", required=True, help="path to file of words to rewrite"
+        "--word_path",
+        default="-",
+        help="path to file of words to rewrite, or - for stdin "
+        "(default: %(default)s)",
     )
     parser.add_argument(
-        "--fst_path", required=True, help="path to rewrite fst FST"
+        "--fst_path",
+        required=True,
+        help="path to rewrite fst FST or model bundle",
     )
     parser.add_argument("--token_type", default="utf8", help="token type")
+    parser.add_argument(
+        "--fst_type",
+        default="vector",
+        choices=bundle.FST_TYPES,
+        help="FST type the model is prepared as for decoding; ignored for "
+        "bundles (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--nshortest",
+        type=int,
+        default=1,
+        help="number of pronunciations to output per word; more than one "
+        "gives word, rank, pronunciation, weight TSV rows "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--weight_threshold",
+        type=float,
+        help="prunes paths whose cost exceeds the best by more than this "
+        "during the n-best search",
+    )
+    parser.add_argument(
+        "--lexicon_path",
+        help="path to lexicon index (see build_lexicon.py) consulted "
+        "before the FST",
+    )
+    parser.add_argument(
+        "--no_lexicon_override",
+        dest="lexicon_override",
+        action="store_false",
+        help="decode in-lexicon words with the FST anyway, only counting "
+        "lexicon hits",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=0,
+        help="maximum number of rewrites memoized in memory "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache_path",
+        help="path to SQLite database persisting rewrites across runs",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=128,
+        help="number of words per task (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1,
+        help="number of batches sent to a worker at once "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--window_size",
+        type=int,
+        default=8192,
+        help="number of words read and length-sorted at once "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_windows",
+        type=int,
+        default=2,
+        help="maximum number of windows in flight (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="log latency percentiles per step, lattice sizes and the "
+        "slowest inputs",
+    )
+    parser.add_argument(
+        "--stats_path",
+        help="path to write the latency statistics to as JSON; implies "
+        "--stats",
+    )
+    parser.add_argument(
+        "--slowest",
+        type=int,
+        default=10,
+        help="number of slowest inputs reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile_path",
+        help="path to write a cProfile profile of a sample of words to",
+    )
+    parser.add_argument(
+        "--profile_rate",
+        type=float,
+        default=0.01,
+        help="fraction of words profiled with --profile_path "
+        "(default: %(default)s)",
+    )
     main(parser.parse_args())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Tests for rewrite.py."""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import build_lexicon
+import bundle
+import pynini
+import rewrite
+
+
+class G2PModelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fst_path = os.path.join(self.tmp, "model.fst")
+        pynini.transducer("dog", "dɔɡ").write(self.fst_path)
+        self.lexicon_path = os.path.join(self.tmp, "lexicon.pkl")
+        build_lexicon._write({"cat": "kæt"}, self.lexicon_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            # A window that never completes would otherwise hang the test.
+            return loop.run_until_complete(asyncio.wait_for(coroutine, 10))
+        finally:
+            loop.close()
+
+    def test_async_window_of_lexicon_hits(self):
+        with rewrite.G2PModel(
+            self.fst_path, lexicon_path=self.lexicon_path, workers=1
+        ) as model:
+            prons = self._run(model.transcribe_batch_async(["cat", "cat"]))
+        self.assertEqual(prons, ["kæt", "kæt"])
+
+    def test_async_window_of_cache_hits(self):
+        with rewrite.G2PModel(
+            self.fst_path, workers=1, cache_size=10
+        ) as model:
+            expected = model.transcribe_batch(["dog"])
+            prons = self._run(model.transcribe_batch_async(["dog"]))
+        self.assertEqual(prons, expected)
+
+    def test_sync_window_of_lexicon_hits(self):
+        with rewrite.G2PModel(
+            self.fst_path, lexicon_path=self.lexicon_path, workers=1
+        ) as model:
+            self.assertEqual(model.transcribe_batch(["cat"]), ["kæt"])
+
+
+
+class PreparedModelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fst_path = os.path.join(self.tmp, "model.fst")
+        self.model = pynini.union(
+            pynini.transducer("a", "x"),
+            pynini.transducer("a", "yy", weight=1),
+            pynini.transducer("b", "z"),
+            pynini.transducer("b", "", weight=0.5),
+        ).closure()
+        self.model.write(self.fst_path)
+        self.words = ["a", "b", "ab", "bab", "aabb"]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _rewrites(self, path, fst_type, nshortest):
+        rewriter = rewrite._Rewriter.from_args(
+            path, "utf8", fst_type, nshortest=nshortest
+        )
+        return [rewriter.rewrite(word) for word in self.words]
+
+    def test_fst_types_match_vector(self):
+        for nshortest in (1, 3):
+            expected = self._rewrites(self.fst_path, "vector", nshortest)
+            for fst_type in bundle.FST_TYPES:
+                self.assertEqual(
+                    self._rewrites(self.fst_path, fst_type, nshortest),
+                    expected,
+                )
+
+    def test_bundles_match_vector(self):
+        bundle_path = os.path.join(self.tmp, "model.bundle")
+        for nshortest in (1, 3):
+            expected = self._rewrites(self.fst_path, "vector", nshortest)
+            for fst_type in bundle.FST_TYPES:
+                bundle._write(bundle_path, self.model, "utf8", {}, fst_type)
+                self.assertEqual(
+                    self._rewrites(bundle_path, fst_type, nshortest),
+                    expected,
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
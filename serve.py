@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Serves a rewrite FST over a Unix socket or localhost TCP.
+
+Requests and responses are JSON objects, one per line. A request
+{"words": [...]} is answered with {"prons": [...]}, in order, and a request
+{"metrics": true} with the server metrics; an "id" in a request is echoed back.
+
+The model stays loaded in preloaded workers. Words from concurrent requests are
+coalesced into micro-batches of at most --max_batch_size words, waiting at most
+--max_wait_ms for a batch to fill."""
+
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import time
+
+from typing import Any, Dict, List, Tuple
+
+import bundle
+import common
+import rewrite
+
+
+class _MicroBatcher:
+    """Coalesces words from concurrent requests into batches.
+
+    A batch is dispatched as soon as it holds `max_batch_size` words, or
+    `max_wait` seconds after its first word arrived. Batches are transcribed
+    concurrently, so a slow batch does not hold up the queue."""
+
+    def __init__(
+        self, model: rewrite.G2PModel, max_batch_size: int, max_wait: float
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.batches = 0
+        self.words = 0
+        self.failures = 0
+        # Time from a word's arrival to its pronunciation, and per batch.
+        self.latency = common._Histogram()
+        self.batch_latency = common._Histogram()
+        self.started = time.time()
+
+    async def transcribe(self, words: List[str]) -> List[str]:
+        loop = asyncio.get_event_loop()
+        futures = []
+        for word in words:
+            future = loop.create_future()
+            self.queue.put_nowait((word, future, loop.time()))
+            futures.append(future)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await asyncio.gather(*futures)
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self.queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(
+        self, batch: List[Tuple[str, asyncio.Future, float]]
+    ) -> None:
+        loop = asyncio.get_event_loop()
+        self.in_flight += 1
+        started = loop.time()
+        try:
+            prons = await self.model.transcribe_batch_async(
+                [word for (word, _, _) in batch]
+            )
+        except Exception as error:
+            self.failures += 1
+            for (_, future, _) in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        finally:
+            self.in_flight -= 1
+        finished = loop.time()
+        self.batches += 1
+        self.words += len(batch)
+        self.batch_latency.add(finished - started)
+        for ((_, future, enqueued), pron) in zip(batch, prons):
+            self.latency.add(finished - enqueued)
+            if not future.done():
+                future.set_result(pron)
+
+    def metrics(self) -> Dict[str, Any]:
+        elapsed = time.time() - self.started
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "batches_in_flight": self.in_flight,
+            "batches": self.batches,
+            "words": self.words,
+            "failed_batches": self.failures,
+            "mean_batch_size": (
+                self.words / self.batches if self.batches else 0
+            ),
+            "words_per_second": self.words / elapsed if elapsed else 0,
+            "latency": {
+                f"p{q}": self.latency.percentile(q)
+                for q in common.PERCENTILES
+            },
+            "batch_latency": {
+                f"p{q}": self.batch_latency.percentile(q)
+                for q in common.PERCENTILES
+            },
+        }
+
+    def log(self) -> None:
+        metrics = self.metrics()
+        logging.info(
+            "Queue depth %d (max %d), %d batches in flight, %d words in %d "
+            "batches, latency p50 %.3f ms p95 %.3f ms p99 %.3f ms",
+            metrics["queue_depth"],
+            metrics["max_queue_depth"],
+            metrics["batches_in_flight"],
+            metrics["words"],
+            metrics["batches"],
+            *(1000 * latency for latency in metrics["latency"].values()),
+        )
+
+
+def _handler(batcher: _MicroBatcher):
+    async def _handle(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # Requests on one connection are answered in order; concurrency
+        # comes from concurrent connections.
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if request.get("metrics"):
+                    response = batcher.metrics()
+                else:
+                    words = request.get("words")
+                    # A bad word would fail the whole micro-batch, and with
+                    # it the requests of other clients.
+                    if not isinstance(words, list) or not all(
+                        isinstance(word, str) for word in words
+                    ):
+                        raise ValueError('"words" must be a list of strings')
+                    response = {"prons": await batcher.transcribe(words)}
+                if "id" in request:
+                    response["id"] = request["id"]
+            except Exception as error:
+                response = {"error": str(error)}
+            writer.write(json.dumps(response).encode("utf8") + b"\n")
+            await writer.drain()
+        writer.close()
+
+    return _handle
+
+
+async def _log_metrics(batcher: _MicroBatcher, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        batcher.log()
+
+
+def main(args: argparse.Namespace) -> None:
+    with rewrite.G2PModel(
+        args.fst_path,
+        args.token_type,
+        args.fst_type,
+        args.lexicon_path,
+        args.lexicon_override,
+        args.nshortest,
+        args.weight_threshold,
+        args.workers,
+        # Each micro-batch is split into a few tasks, so that it is still
+        # spread across workers.
+        batch_size=max(1, args.max_batch_size // 4),
+        cache_size=args.cache_size,
+    ) as model:
+        loop = asyncio.get_event_loop()
+        batcher = _MicroBatcher(
+            model, args.max_batch_size, args.max_wait_ms / 1000
+        )
+        if args.socket_path:
+            server = loop.run_until_complete(
+                asyncio.start_unix_server(
+                    _handler(batcher), path=args.socket_path
+                )
+            )
+            logging.info("Listening on %s", args.socket_path)
+        else:
+            server = loop.run_until_complete(
+                asyncio.start_server(
+                    _handler(batcher), host="127.0.0.1", port=args.port
+                )
+            )
+            logging.info("Listening on 127.0.0.1:%d", args.port)
+        tasks = [asyncio.ensure_future(batcher.run())]
+        if args.metrics_interval:
+            tasks.append(
+                asyncio.ensure_future(
+                    _log_metrics(batcher, args.metrics_interval)
+                )
+            )
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, loop.stop)
+        loop.run_forever()
+        logging.info("Shutting down")
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        for task in tasks:
+            task.cancel()
+        batcher.log()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--fst_path",
+        required=True,
+        help="path to rewrite fst FST or model bundle",
+    )
+    parser.add_argument("--token_type", default="utf8", help="token type")
+    parser.add_argument(
+        "--fst_type",
+        default="vector",
+        choices=bundle.FST_TYPES,
+        help="FST type the model is prepared as for decoding; ignored for "
+        "bundles (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--nshortest",
+        type=int,
+        default=1,
+        help="number of pronunciations to output per word "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--weight_threshold",
+        type=float,
+        help="prunes paths whose cost exceeds the best by more than this "
+        "during the n-best search",
+    )
+    parser.add_argument(
+        "--lexicon_path",
+        help="path to lexicon index (see build_lexicon.py) consulted "
+        "before the FST",
+    )
+    parser.add_argument(
+        "--no_lexicon_override",
+        dest="lexicon_override",
+        action="store_false",
+        help="decode in-lexicon words with the FST anyway",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=0,
+        help="maximum number of rewrites memoized in memory "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket_path", help="Unix socket path to listen on")
+    address.add_argument(
+        "--port", type=int, help="localhost TCP port to listen on"
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=256,
+        help="maximum number of words per micro-batch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=2,
+        help="maximum time to wait for a micro-batch to fill, in "
+        "milliseconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        default=60,
+        help="seconds between metrics log lines, or 0 for none "
+        "(default: %(default)s)",
+    )
+    main(parser.parse_args())
@@ -2,39 +2,78 @@
 """Performs a 80-10-10 split of the data.
 
 This script is totally agnostic to the data format, except that it assumes one
-example per line."""
+example per line. Each example is assigned to a subset by a seeded hash of its
+key, the text before the first tab (i.e., the word of a lexicon entry), so the
+split is made in a single pass in constant memory, all entries for a word end
+up in the same subset, and adding examples does not move any others.
+
+Optionally, the data is also split into k folds in the same pass, writing a
+training and test file per fold."""
 
 
 import argparse
+import contextlib
+import hashlib
 import logging
-import random
+
+from typing import List, TextIO, Tuple
+
+# Output buffer size in bytes.
+BUFFER_SIZE = 1 << 20
+
+
+def _assign(key: str, seed: int) -> Tuple[float, float]:
+    """Hashes a key to two independent uniform values in [0, 1).
+
+    The first picks the subset and the second the fold."""
+    digest = hashlib.blake2b(
+        key.encode("utf8"), digest_size=16, key=str(seed).encode("utf8")
+    ).digest()
+    return (
+        int.from_bytes(digest[:8], "big") / (1 << 64),
+        int.from_bytes(digest[8:], "big") / (1 << 64),
+    )
+
+
+def _open_sink(stack: contextlib.ExitStack, path: str) -> TextIO:
+    return stack.enter_context(open(path, "w", buffering=BUFFER_SIZE))
 
 
 def main(args: argparse.Namespace) -> None:
-    # Reads in data and shuffles.
-    with open(args.input_path, "r") as source:
-        data = [line.rstrip() for line in source]
-    random.seed(args.seed)
-    random.shuffle(data)
-    # Creates split boundaries.
-    train_right = int(len(data) * 0.8)
-    dev_right = int(len(data) * 0.9)
-    # Writes them out.
-    subset = data[:train_right]
-    logging.info("Train set:\t%d lines", len(subset))
-    with open(args.train_path, "w") as sink:
-        for line in subset:
-            print(line, file=sink)
-    subset = data[train_right:dev_right]
-    logging.info("Development set:\t%d lines", len(subset))
-    with open(args.dev_path, "w") as sink:
-        for line in subset:
-            print(line, file=sink)
-    subset = data[dev_right:]
-    logging.info("Test set:\t\t%d lines", len(subset))
-    with open(args.test_path, "w") as sink:
-        for line in subset:
-            print(line, file=sink)
+    counts = [0, 0, 0]
+    with contextlib.ExitStack() as stack:
+        sinks = [
+            _open_sink(stack, path)
+            for path in (args.train_path, args.dev_path, args.test_path)
+        ]
+        fold_sinks: List[Tuple[TextIO, TextIO]] = []
+        for fold in range(args.folds):
+            fold_sinks.append(
+                (
+                    _open_sink(stack, f"{args.fold_prefix}{fold}.train.tsv"),
+                    _open_sink(stack, f"{args.fold_prefix}{fold}.test.tsv"),
+                )
+            )
+        with open(args.input_path, "r") as source:
+            for line in source:
+                line = line.rstrip()
+                (subset, fold) = _assign(line.split("\t", 1)[0], args.seed)
+                # Creates split boundaries.
+                index = 0 if subset < 0.8 else 1 if subset < 0.9 else 2
+                counts[index] += 1
+                print(line, file=sinks[index])
+                if fold_sinks:
+                    fold = int(fold * args.folds)
+                    for (other, (train_sink, test_sink)) in enumerate(
+                        fold_sinks
+                    ):
+                        sink = test_sink if other == fold else train_sink
+                        print(line, file=sink)
+    logging.info("Train set:\t%d lines", counts[0])
+    logging.info("Development set:\t%d lines", counts[1])
+    logging.info("Test set:\t\t%d lines", counts[2])
+    if args.folds:
+        logging.info("%d folds written", args.folds)
 
 
 if __name__ == "__main__":
@@ -44,7 +83,7 @@ if __name__ == "__main__":
         "--seed",
         type=int,
         required=True,
-        help="random seed for shuffling data",
+        help="random seed for hashing data",
     )
     parser.add_argument(
         "--input_path", required=True, help="path to input data"
@@ -58,4 +97,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--test_path", required=True, help="path to output test data"
     )
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=0,
+        help="number of folds to also split the data into (default: none)",
+    )
+    parser.add_argument(
+        "--fold_prefix",
+        default="fold",
+        help="path prefix of the fold outputs, written as "
+        "PREFIX{fold}.train.tsv and PREFIX{fold}.test.tsv "
+        "(default: %(default)s)",
+    )
     main(parser.parse_args())
@@ -0,0 +1,135 @@
+"""Content-addressed cache of training pipeline artifacts.
+
+Each entry is a directory named after a pipeline stage and a key, holding the
+stage's output files and a manifest mapping artifact names to file names (or
+lists of file names, for sharded outputs). Entries are published by renaming a
+complete temporary directory, so a partially written entry is never visible.
+When the cache grows beyond its size limit, the least recently used entries
+are evicted."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from typing import Any, Dict, List, Optional, Set, Union
+
+
+Artifacts = Dict[str, Union[str, List[str]]]
+
+_MANIFEST = "manifest.json"
+
+
+def _file_hash(path: str) -> str:
+    """Hashes the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _key(*parts: Any) -> str:
+    """Hashes stage parameters, including the key of the previous stage."""
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True).encode("utf8")
+    ).hexdigest()
+
+
+class StageCache:
+    """Stores stage artifacts under `cache_dir`, up to `max_bytes` in all."""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        # Entries used by this run, which are never evicted by it.
+        self.pinned: Set[str] = set()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{stage}-{key}")
+
+    def owns(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(self.cache_dir + os.sep)
+
+    def get(self, stage: str, key: str) -> Optional[Artifacts]:
+        """Returns the artifacts of a stage, with absolute paths, if cached."""
+        entry = self._entry(stage, key)
+        try:
+            with open(os.path.join(entry, _MANIFEST), "r") as source:
+                manifest = json.load(source)
+        except FileNotFoundError:
+            logging.info("Stage cache miss: %s", stage)
+            return None
+        logging.info("Stage cache hit: %s", stage)
+        # Touching the entry marks it as recently used.
+        os.utime(entry)
+        self.pinned.add(entry)
+        return self._resolve(entry, manifest)
+
+    def put(self, stage: str, key: str, artifacts: Artifacts) -> Artifacts:
+        """Moves the artifacts of a stage into the cache.
+
+        Returns the artifacts with their new paths."""
+        staging = tempfile.mkdtemp(prefix=".staging.", dir=self.cache_dir)
+        manifest: Artifacts = {}
+        for (name, paths) in artifacts.items():
+            if isinstance(paths, str):
+                manifest[name] = self._move(paths, staging)
+            else:
+                manifest[name] = [self._move(path, staging) for path in paths]
+        with open(os.path.join(staging, _MANIFEST), "w") as sink:
+            json.dump(manifest, sink)
+        entry = self._entry(stage, key)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another run published the same entry first; its files have
+            # other names than ours, so its own manifest is used.
+            shutil.rmtree(staging)
+            published = self.get(stage, key)
+            if published is None:
+                raise
+            return published
+        self.pinned.add(entry)
+        self._evict()
+        return self._resolve(entry, manifest)
+
+    def _move(self, path: str, staging: str) -> str:
+        name = os.path.basename(path)
+        shutil.move(path, os.path.join(staging, name))
+        return name
+
+    def _resolve(self, entry: str, manifest: Artifacts) -> Artifacts:
+        artifacts: Artifacts = {}
+        for (name, paths) in manifest.items():
+            if isinstance(paths, str):
+                artifacts[name] = os.path.join(entry, paths)
+            else:
+                artifacts[name] = [os.path.join(entry, p) for p in paths]
+        return artifacts
+
+    def _evict(self) -> None:
+        """Evicts least recently used entries until under the size limit."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry, f))
+                for f in os.listdir(entry)
+            )
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        for (_, size, entry) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry in self.pinned:
+                continue
+            logging.info("Evicting %s from the stage cache", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
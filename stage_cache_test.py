@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Tests for stage_cache.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import stage_cache
+
+
+class StageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _artifact(self, contents: bytes = b"x" * 1000) -> str:
+        (fd, path) = tempfile.mkstemp(dir=self.tmp)
+        os.write(fd, contents)
+        os.close(fd)
+        return path
+
+    def _read(self, path: str) -> bytes:
+        with open(path, "rb") as source:
+            return source.read()
+
+    def test_miss_then_hit(self):
+        cache = stage_cache.StageCache(self.cache_dir, 1 << 20)
+        self.assertIsNone(cache.get("align", "key"))
+        single = self._artifact(b"far")
+        shards = [self._artifact(b"0"), self._artifact(b"1")]
+        stored = cache.put("align", "key", {"far": single, "shards": shards})
+        self.assertFalse(os.path.exists(single))
+        self.assertEqual(self._read(stored["far"]), b"far")
+        self.assertEqual(
+            [self._read(path) for path in stored["shards"]], [b"0", b"1"]
+        )
+        other = stage_cache.StageCache(self.cache_dir, 1 << 20)
+        self.assertEqual(other.get("align", "key"), stored)
+        self.assertIsNone(other.get("align", "other"))
+
+    def test_owns(self):
+        cache = stage_cache.StageCache(self.cache_dir, 1 << 20)
+        stored = cache.put("align", "key", {"far": self._artifact()})
+        self.assertTrue(cache.owns(stored["far"]))
+        self.assertFalse(cache.owns(self._artifact()))
+        # A sibling directory sharing the cache directory as a prefix.
+        self.assertFalse(cache.owns(self.cache_dir + "2/align-key/far"))
+
+    def test_evicts_least_recently_used_but_not_pinned(self):
+        writer = stage_cache.StageCache(self.cache_dir, 1 << 20)
+        entries = {}
+        for (age, key) in enumerate(("new", "middle", "old", "oldest")):
+            entries[key] = os.path.dirname(
+                writer.put("stage", key, {"out": self._artifact()})["out"]
+            )
+            os.utime(entries[key], (1000 - age, 1000 - age))
+        # Holds about two entries.
+        cache = stage_cache.StageCache(self.cache_dir, 2500)
+        cache.get("stage", "oldest")
+        os.utime(entries["oldest"], (0, 0))
+        cache.put("stage", "latest", {"out": self._artifact()})
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            ["stage-latest", "stage-oldest"],
+        )
+
+    def test_lost_rename_returns_published_entry(self):
+        first = stage_cache.StageCache(self.cache_dir, 1 << 20)
+        second = stage_cache.StageCache(self.cache_dir, 1 << 20)
+        published = first.put(
+            "align", "key", {"far": self._artifact(b"first")}
+        )
+        stored = second.put(
+            "align", "key", {"far": self._artifact(b"second")}
+        )
+        self.assertEqual(stored, published)
+        self.assertEqual(self._read(stored["far"]), b"first")
+        self.assertEqual(os.listdir(self.cache_dir), ["align-key"])
+
+
+if __name__ == "__main__":
+    unittest.main()
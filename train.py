@@ -2,17 +2,33 @@
 """Builds a end pair n-gram model language model."""
 
 import argparse
+import collections
+import contextlib
 import functools
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import resource
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
-from typing import Set
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
+import build_lexicon
 import build_sym
+import bundle
+import evaluate
+import numpy
 import pynini
 import pywrapfst
+import rewrite
+import stage_cache
 
 def _type_reader(_type: str) -> pynini.SymbolTable or str:
     """Allows for token_type from a SymbolTable text file."""
@@ -21,25 +37,360 @@ def _type_reader(_type: str) -> pynini.SymbolTable or str:
     else:
         return _type
 
-class PairNGramTrainer:
-    """ Build a end-to-end g2p pair language model."""
-
-    def __init__(self):
-        self.g_far_path = tempfile.mkstemp(prefix="g.", suffix=".far")[1]
-        self.p_far_path = tempfile.mkstemp(prefix="p.", suffix=".far")[1]
-        self.covering_path = tempfile.mkstemp(
-            prefix="covering.", suffix=".fst"
-        )[1]
-        self.aligner_path = tempfile.mkstemp(prefix="aligner.", suffix=".fat")[
-            1
+# A shard is the line number and byte offset of its first example, and the
+# grapheme and phoneme FAR paths to write it to.
+Shard = Tuple[int, int, str, str]
+
+
+def _labels(f: pynini.Fst) -> Set[int]:
+    """Collects the input labels of an FST from its arcs."""
+    return {arc.ilabel for state in f.states() for arc in f.arcs(state)}
+
+
+# The resource usage of a child process: its command name, CPU time in
+# seconds and peak RSS in bytes.
+Usage = Dict[str, Any]
+
+
+def _usage(name: str, rusage: resource.struct_rusage) -> Usage:
+    return {
+        "command": name,
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+        # On Linux, ru_maxrss is in KiB.
+        "peak_rss": rusage.ru_maxrss * 1024,
+    }
+
+
+def _wait(proc: subprocess.Popen) -> Usage:
+    """Waits for a child process and returns its resource usage."""
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return _usage(os.path.basename(proc.args[0]), rusage)
+
+
+def _call(cmd: List[str]) -> Usage:
+    """Runs a command and returns its resource usage.
+
+    Raises CalledProcessError if the command fails."""
+    proc = subprocess.Popen(cmd)
+    usage = _wait(proc)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return usage
+
+
+def _pipeline(cmds: List[List[str]], output_path: str) -> List[Usage]:
+    """Runs commands with the output of each piped into the next.
+
+    The output of the last command is written to `output_path`. Returns the
+    resource usage of each command, and raises CalledProcessError if any of
+    them fails."""
+    usages = []
+    procs = []
+    source = None
+    with open(output_path, "wb") as sink:
+        try:
+            for (index, cmd) in enumerate(cmds):
+                last = index == len(cmds) - 1
+                proc = subprocess.Popen(
+                    cmd,
+                    stdin=source,
+                    stdout=sink if last else subprocess.PIPE,
+                )
+                procs.append(proc)
+                # Only the next command holds the pipe, so the previous one
+                # sees it close if that command exits early.
+                if source is not None:
+                    source.close()
+                source = proc.stdout
+        finally:
+            if source is not None:
+                source.close()
+            for proc in procs:
+                usages.append(_wait(proc))
+    for (cmd, proc) in zip(cmds, procs):
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return usages
+
+
+def _shard_offsets(path: str, shard_size: int) -> Iterator[Tuple[int, int]]:
+    """Yields the line number and byte offset at which each shard starts."""
+    with open(path, "rb") as source:
+        offset = 0
+        for (linenum, line) in enumerate(source, 1):
+            if (linenum - 1) % shard_size == 0:
+                yield (linenum, offset)
+            offset += len(line)
+
+
+def _dedup(input_path: str, unique_path: str) -> Tuple[int, int]:
+    """Writes the unique pairs of a lexicon, each preceded by its count.
+
+    Pairs are written in order of first occurrence. The count is only carried
+    to the FARs, which repeat each pair that many times for the aligner and
+    the n-gram counter. Returns the number of examples and of unique
+    pairs."""
+    counts: Dict[str, int] = collections.Counter()
+    with open(input_path, "r") as source:
+        for line in source:
+            counts[line.rstrip()] += 1
+    with open(unique_path, "w") as sink:
+        for (line, count) in counts.items():
+            print(count, line, sep="\t", file=sink)
+    return (sum(counts.values()), len(counts))
+
+
+def _multiplicity(key: str) -> int:
+    """Reads the count of a pair from its FAR key, if it has one."""
+    (_, _, count) = key.partition(".")
+    return int(count) if count else 1
+
+
+def _repeat(key: str) -> Iterator[str]:
+    """Yields a key for each occurrence of a pair, in key order."""
+    count = _multiplicity(key)
+    if count == 1:
+        yield key
+    else:
+        for index in range(count):
+            yield f"{key}.{index:08x}"
+
+
+def _compile_shard(
+    token_type: str,
+    input_path: str,
+    shard_size: int,
+    weighted: bool,
+    shard: Shard,
+) -> Tuple[Set[int], Set[int], int, float, Usage]:
+    """Compiles a shard of the lexicon into grapheme and phoneme FARs.
+
+    If `weighted` is set, each line starts with the count of its pair, which
+    is carried in the FAR key. Returns the grapheme and phoneme labels seen,
+    the number of examples, the time taken and the resources used."""
+    started = time.time()
+    cpu = time.process_time()
+    (start, offset, g_far_path, p_far_path) = shard
+    with open(input_path, "rb") as source:
+        source.seek(offset)
+        lines = [
+            line.decode("utf8")
+            for line in itertools.islice(source, shard_size)
         ]
-        self.far_path = tempfile.mkstemp(prefix="far.", suffix=".far")[1]
-        self.fsa_path = tempfile.mkstemp(prefix="fsa.", suffix=".far")[1]
-        self.count_path = tempfile.mkstemp(prefix="count.", suffix=".fst")[1]
-        self.lm_path = tempfile.mkstemp(prefix="lm.", suffix=".fst")[1]
-        self.shrunk_lm_path = tempfile.mkstemp(
-            prefix="shrunk.", suffix=".fst"
-        )[1]
+    g_labels: Set[int] = set()
+    p_labels: Set[int] = set()
+    # Curries compiler and compactor functions for the FARs.
+    compiler = functools.partial(
+        pynini.acceptor, token_type=_type_reader(token_type), attach_symbols=False
+    )
+    compactor = functools.partial(pywrapfst.convert, fst_type="compact_string")
+    g_writer = pywrapfst.FarWriter.create(g_far_path)
+    p_writer = pywrapfst.FarWriter.create(p_far_path)
+    keys = []
+    gs = []
+    ps = []
+    for (linenum, line) in enumerate(lines, start):
+        # Keys are global line numbers, so they do not depend on sharding.
+        key = f"{linenum:08x}"
+        if weighted:
+            (count, line) = line.split("\t", 1)
+            key = f"{key}.{count}"
+        (g, p) = line.rstrip().split("\t", 1)
+        keys.append(key)
+        gs.append(g)
+        ps.append(p)
+    if token_type not in {"byte", "utf8"}:
+        # Each side of the shard is tokenized in a single pass.
+        gs = build_sym._tokenize_batch(gs)
+        ps = build_sym._tokenize_batch(ps)
+    for (key, g, p) in zip(keys, gs, ps):
+        # For both G and P, we compile a FSA, store the labels, and then
+        # write the compact version to the FAR.
+        g_fst = compiler(g)
+        g_labels.update(_labels(g_fst))
+        g_writer[key] = compactor(g_fst)
+        p_fst = compiler(p)
+        p_labels.update(_labels(p_fst))
+        p_writer[key] = compactor(p_fst)
+    # Deleting the writers flushes and closes the FARs.
+    del g_writer
+    del p_writer
+    usage = _usage("compile", resource.getrusage(resource.RUSAGE_SELF))
+    usage["cpu_time"] = time.process_time() - cpu
+    return (g_labels, p_labels, len(lines), time.time() - started, usage)
+
+
+def _merge_fars(paths: List[str], far_path: str) -> None:
+    """Merges FARs with disjoint keys into one, in key order.
+
+    Pairs are repeated as many times as they occur in the lexicon."""
+    writer = pywrapfst.FarWriter.create(far_path)
+    reader = pywrapfst.FarReader.open(*paths)
+    while not reader.done():
+        fst = reader.get_fst()
+        for key in _repeat(reader.get_key()):
+            writer[key] = fst
+        reader.next()
+    del writer
+
+
+def _dev_score(
+    model_path: str, token_type: str, dev_path: str
+) -> Tuple[float, float]:
+    """Computes the WER and LER of a model on a two-column TSV file."""
+    rewriter = rewrite._Rewriter.from_args(model_path, token_type)
+    pairs = []
+    with open(dev_path, "r") as source:
+        for line in source:
+            (g, p) = line.rstrip().split("\t", 1)
+            if token_type not in {"byte", "utf8"}:
+                g = build_sym._tokenize(g)
+                # Symbols are written space-separated.
+                hypo = rewriter.rewrite(g).replace(" ", "")
+            else:
+                hypo = rewriter.rewrite(g)
+            pairs.append((p, hypo))
+    (edits, lengths) = evaluate._score_batch(pairs)
+    return (
+        float(numpy.count_nonzero(edits) / len(pairs)),
+        float(edits.sum() / lengths.sum()),
+    )
+
+
+class PairNGramTrainer:
+    """ Build a end-to-end g2p pair language model.
+
+    The lexicon is compiled and aligned in shards of `shard_size` examples
+    across `processes` worker processes (by default, the number of CPUs). If
+    `aligner_shards` is set, the aligner is trained on only that many evenly
+    spaced shards rather than on the whole lexicon. If `sharded_counting` is
+    set, n-grams are counted per shard in parallel and the counts merged. If
+    `dedup` is set, repeated pairs in the lexicon are compiled and aligned
+    only once; they are still repeated as often as they occur when the
+    aligner is trained and when n-grams are counted, so dedup saves only
+    compilation and decoding time.
+
+    If a `cache` is given, the output of each stage is stored in it, keyed by
+    a hash of the input lexicon and the parameters the stage depends on, and
+    stages whose output is already cached are skipped.
+
+    The wall time, CPU time and peak RSS of each stage run are recorded in
+    `report`; if `instrument` is set, so are the sizes of the FSTs they
+    write.
+
+    Intermediate files are kept in a scratch directory per run, created under
+    `scratch_root` (by default, the system temporary directory); pointing it
+    at a tmpfs keeps them off disk."""
+
+    def __init__(
+        self,
+        processes: Optional[int] = None,
+        shard_size: int = 100000,
+        aligner_shards: Optional[int] = None,
+        sharded_counting: bool = False,
+        cache: Optional[stage_cache.StageCache] = None,
+        scratch_root: Optional[str] = None,
+        dedup: bool = False,
+        instrument: bool = False,
+    ):
+        self.processes = processes
+        self.shard_size = shard_size
+        self.aligner_shards = aligner_shards
+        self.sharded_counting = sharded_counting
+        self.cache = cache
+        # Guards the encoded FARs and counts shared by concurrent stages.
+        self.lock = threading.RLock()
+        self.keys: Dict[str, Optional[str]] = {}
+        self.encoded: Optional[Tuple[pynini.EncodeMapper, List[str]]] = None
+        self.counts: Dict[int, Tuple[pynini.EncodeMapper, str]] = {}
+        self.g_shard_paths: List[str] = []
+        self.p_shard_paths: List[str] = []
+        self.far_shard_paths: List[str] = []
+        self.scratch_root = scratch_root
+        self.scratch_dir: Optional[str] = None
+        self.dedup = dedup
+        self.instrument = instrument
+        self.report: List[Dict[str, Any]] = []
+
+    def _temp(self, prefix: str, suffix: str) -> str:
+        """Creates a temporary file in the per-run scratch directory."""
+        (fd, path) = tempfile.mkstemp(
+            prefix=prefix, suffix=suffix, dir=self.scratch_dir
+        )
+        os.close(fd)
+        return path
+
+    @contextlib.contextmanager
+    def _measure(self, stage: str, **params: Any) -> Iterator[Dict[str, Any]]:
+        """Records the resources used by a stage in the report.
+
+        The stage adds the usage of the commands it runs to "children", and
+        may set "fst" or "fst_path" to its output to record its size. CPU
+        time is that of this process plus that of the children; peak RSS is
+        that of the largest child, or of this process if there are none."""
+        record: Dict[str, Any] = {"stage": stage, "params": params}
+        record["children"] = []
+        started = time.time()
+        cpu = time.process_time()
+        yield record
+        record["started"] = started
+        record["wall_time"] = time.time() - started
+        children = record["children"]
+        record["cpu_time"] = time.process_time() - cpu + sum(
+            child["cpu_time"] for child in children
+        )
+        if children:
+            record["peak_rss"] = max(child["peak_rss"] for child in children)
+        else:
+            rusage = resource.getrusage(resource.RUSAGE_SELF)
+            record["peak_rss"] = _usage(stage, rusage)["peak_rss"]
+        fst = record.pop("fst", None)
+        fst_path = record.pop("fst_path", None)
+        # Outputs on disk are only read back if a report is wanted.
+        if fst is None and fst_path is not None and self.instrument:
+            fst = pynini.Fst.read(fst_path)
+        if fst is not None:
+            record["states"] = fst.num_states()
+            record["arcs"] = self._narcs(fst)
+        logging.info(
+            "Stage %s: %.2f s wall, %.2f s CPU",
+            stage,
+            record["wall_time"],
+            record["cpu_time"],
+        )
+        # Appending is atomic, so stages in other threads need no lock.
+        self.report.append(record)
+
+    def _drivers(self) -> multiprocessing.pool.ThreadPool:
+        """Returns a pool to run commands of a stage in parallel.
+
+        The work is done by the OpenGrm subprocesses, so threads suffice to
+        drive them."""
+        return multiprocessing.pool.ThreadPool(self.processes)
+
+    @contextlib.contextmanager
+    def _scratch(self) -> Iterator[None]:
+        """Holds the intermediate files of a run in one scratch directory.
+
+        The directory is removed when the run ends, whether or not it
+        succeeded."""
+        self.scratch_dir = tempfile.mkdtemp(
+            prefix="pairngram.", dir=self.scratch_root
+        )
+        try:
+            self.g_far_path = self._temp("g.", ".far")
+            self.p_far_path = self._temp("p.", ".far")
+            self.covering_path = self._temp("covering.", ".fst")
+            self.aligner_path = self._temp("aligner.", ".fat")
+            self.fsa_path = self._temp("fsa.", ".far")
+            yield
+        finally:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
 
     def _label_union(self, labels: Set[int], epsilon: bool) -> pynini.Fst:
         """Creates FSA over a union of the labels."""
@@ -65,36 +416,64 @@ class PairNGramTrainer:
         input_path: str,
         input_epsilon: bool,
         output_epsilon: bool,
-    ) -> None:
+    ) -> List[Usage]:
+        """Compiles the lexicon FARs and the covering grammar.
+
+        Returns the resources used by each shard."""
         # Sets of labels for the covering grammar.
         g_labels: Set[int] = set()
         p_labels: Set[int] = set()
-        # Curries compiler and compactor functions for the FARs.
+        logging.info("Constructing grapheme and phoneme FARs")
+        unique_path = None
+        if self.dedup:
+            unique_path = self._temp("unique.", ".tsv")
+            (examples, unique) = _dedup(input_path, unique_path)
+            logging.info(
+                "%d examples, %d unique pairs (dedup ratio %.2f)",
+                examples,
+                unique,
+                examples / max(1, unique),
+            )
+            input_path = unique_path
+        # Each worker reads its own shard, so the parent only keeps offsets.
+        offsets = list(_shard_offsets(input_path, self.shard_size))
+        self.g_shard_paths = [
+            self._temp(f"g.{index:04d}.", ".far")
+            for index in range(len(offsets))
+        ]
+        self.p_shard_paths = [
+            self._temp(f"p.{index:04d}.", ".far")
+            for index in range(len(offsets))
+        ]
+        shards = [
+            (start, offset, g_path, p_path)
+            for ((start, offset), g_path, p_path) in zip(
+                offsets, self.g_shard_paths, self.p_shard_paths
+            )
+        ]
+        examples = 0
+        usages = []
         compiler = functools.partial(
-            pynini.acceptor, token_type=_type_reader(token_type), attach_symbols=False
-        )
-        compactor = functools.partial(
-            pywrapfst.convert, fst_type="compact_string"
+            _compile_shard,
+            token_type,
+            input_path,
+            self.shard_size,
+            self.dedup,
         )
-        logging.info("Constructing grapheme and phoneme FARs")
-        g_writer = pywrapfst.FarWriter.create(self.g_far_path)
-        p_writer = pywrapfst.FarWriter.create(self.p_far_path)
-        with open(input_path, "r") as source:
-            for (linenum, line) in enumerate(source, 1):
-                key = f"{linenum:08x}"
-                (g, p) = line.rstrip().split("\t", 1)
-                if token_type not in {"byte", "utf8"}:
-                    g = " ".join(build_sym._char_processor(g))
-                    p = " ".join(build_sym._char_processor(p))
-                # For both G and P, we compile a FSA, store the labels, and then
-                # write the compact version to the FAR.
-                g_fst = compiler(g)
-                g_labels.update(g_fst.paths().ilabels())
-                g_writer[key] = compactor(g_fst)
-                p_fst = compiler(p)
-                p_labels.update(p_fst.paths().ilabels())
-                p_writer[key] = compactor(p_fst)
-        logging.info("Processed %d examples", linenum)
+        with multiprocessing.Pool(self.processes) as pool:
+            for (index, (g, p, n, elapsed, usage)) in enumerate(
+                pool.imap(compiler, shards)
+            ):
+                logging.info(
+                    "Shard %d: %d examples in %.2f s", index, n, elapsed
+                )
+                g_labels.update(g)
+                p_labels.update(p)
+                examples += n
+                usages.append(usage)
+        if unique_path is not None:
+            os.remove(unique_path)
+        logging.info("Processed %d examples", examples)
         logging.info("Constructing covering grammar")
         logging.info("%d unique graphemes", len(g_labels))
         g_side = self._label_union(g_labels, input_epsilon)
@@ -105,126 +484,625 @@ class PairNGramTrainer:
         assert covering.num_states() == 1, "Covering grammar FST is ill-formed"
         logging.info("Covering grammar has %d arcs", self._narcs(covering))
         covering.write(self.covering_path)
+        return usages
 
-    def _alignment(
-        self
-    ):  # This method has to be changed after parallel aligner traning
-        #  becomes available.
-        logging.info("Baum-welch aligner training starts.")
-        cmd = [
-            "baumwelchtrain",
-            self.g_far_path,
-            self.p_far_path,
-            self.covering_path,
-            self.aligner_path,
-        ]
-        subprocess.check_call(cmd)
-        os.remove(self.covering_path)
-        cmd = [
-            "baumwelchdecode",
-            self.g_far_path,
-            self.p_far_path,
-            self.aligner_path,
-            self.far_path,
-        ]
-        subprocess.check_call(cmd)
+    def _alignment(self):
+        # The aligner is trained once, on all shards or an evenly spaced
+        # sample of them, and then every shard is decoded in parallel.
+        if self.aligner_shards:
+            step = max(1, len(self.g_shard_paths) // self.aligner_shards)
+            indices = range(0, len(self.g_shard_paths), step)
+            indices = list(indices)[: self.aligner_shards]
+        else:
+            indices = range(len(self.g_shard_paths))
+        logging.info(
+            "Training the aligner on %d of %d shards",
+            len(indices),
+            len(self.g_shard_paths),
+        )
+        with self._measure("baumwelchtrain", shards=len(indices)) as record:
+            _merge_fars(
+                [self.g_shard_paths[i] for i in indices], self.g_far_path
+            )
+            _merge_fars(
+                [self.p_shard_paths[i] for i in indices], self.p_far_path
+            )
+            logging.info("Baum-welch aligner training starts.")
+            cmd = [
+                "baumwelchtrain",
+                self.g_far_path,
+                self.p_far_path,
+                self.covering_path,
+                self.aligner_path,
+            ]
+            record["children"].append(_call(cmd))
+            record["fst_path"] = self.aligner_path
+        self._release(self.covering_path)
         os.remove(self.g_far_path)
         os.remove(self.p_far_path)
+        self.far_shard_paths = [
+            self._temp(f"far.{index:04d}.", ".far")
+            for index in range(len(self.g_shard_paths))
+        ]
+
+        def _decode(index: int) -> float:
+            started = time.time()
+            cmd = [
+                "baumwelchdecode",
+                self.g_shard_paths[index],
+                self.p_shard_paths[index],
+                self.aligner_path,
+                self.far_shard_paths[index],
+            ]
+            with self._measure("baumwelchdecode", shard=index) as record:
+                record["children"].append(_call(cmd))
+            return time.time() - started
+
+        with self._drivers() as pool:
+            for (index, elapsed) in enumerate(
+                pool.imap(_decode, range(len(self.far_shard_paths)))
+            ):
+                logging.info("Shard %d aligned in %.2f s", index, elapsed)
+        # Keys are global line numbers, so the alignment shards read in order
+        # are the same as a single decoder run over the whole lexicon.
+        self._release(*self.g_shard_paths, *self.p_shard_paths)
         os.remove(self.aligner_path)
-        logging.info("Alignments.far is created.")
+        logging.info("Alignment FARs are created.")
 
-    def _building_model(
+    def _counting(
+        self, order: int, fsa_paths: List[str], count_path: str
+    ) -> None:
+        """Counts n-grams of each encoded FAR and merges the counts."""
+        final_path = count_path
+
+        def _count(fsa_path: str) -> str:
+            if len(fsa_paths) == 1:
+                count_path = final_path
+            else:
+                count_path = self._temp("count.", ".fst")
+            cmd = [
+                "ngramcount",
+                "--require_symbols=false",
+                f"--order={order}",
+                fsa_path,
+                count_path,
+            ]
+            with self._measure("ngramcount", order=order) as record:
+                record["children"].append(_call(cmd))
+                if count_path == final_path:
+                    record["fst_path"] = count_path
+            return count_path
+
+        def _merge(pair: List[str], final: bool) -> str:
+            if len(pair) == 1:
+                return pair[0]
+            if final:
+                merged_path = final_path
+            else:
+                merged_path = self._temp("count.", ".fst")
+            # Count merging adds the counts, so the result is the same as
+            # counting all shards at once.
+            cmd = ["ngrammerge", "--method=count_merge", *pair, merged_path]
+            with self._measure("ngrammerge", order=order) as record:
+                record["children"].append(_call(cmd))
+                if final:
+                    record["fst_path"] = merged_path
+            for path in pair:
+                os.remove(path)
+            return merged_path
+
+        with self._drivers() as pool:
+            count_paths = pool.map(_count, fsa_paths)
+            # Merges pairwise, halving the number of counts each round.
+            while len(count_paths) > 1:
+                pairs = [
+                    count_paths[i : i + 2]
+                    for i in range(0, len(count_paths), 2)
+                ]
+                count_paths = pool.starmap(
+                    _merge, [(pair, len(pairs) == 1) for pair in pairs]
+                )
+
+    def _encoding(self) -> Tuple[pynini.EncodeMapper, List[str]]:
+        """Encodes the alignments as FSAs.
+
+        Returns the encoder and the encoded FARs: one per shard if counting
+        is sharded, otherwise one in all."""
+        with pynini.Far(self.far_shard_paths[0], mode="r") as far_reader:
+            arc_type = far_reader.arc_type()
+        # All shards share one encoder, so their encoded labels agree.
+        encoder = pynini.EncodeMapper(arc_type, encode_labels=True)
+        if self.sharded_counting:
+            groups = [[path] for path in self.far_shard_paths]
+            fsa_paths = [
+                self._temp(f"fsa.{index:04d}.", ".far")
+                for index in range(len(groups))
+            ]
+            os.remove(self.fsa_path)
+        else:
+            groups = [self.far_shard_paths]
+            fsa_paths = [self.fsa_path]
+        for (group, fsa_path) in zip(groups, fsa_paths):
+            with pynini.Far(
+                fsa_path, mode="w", arc_type=arc_type, far_type="default"
+            ) as far_writer:
+                for far_path in group:
+                    with pynini.Far(far_path, mode="r") as far_reader:
+                        while not far_reader.done():
+                            fst = far_reader.get_fst()
+                            fst.encode(encoder)
+                            # Each pair is aligned and encoded once, but
+                            # written as often as it occurs, so ngramcount
+                            # reads the full lexicon.
+                            for key in _repeat(far_reader.get_key()):
+                                far_writer.add(key, fst)
+                            far_reader.next()
+        self._release(*self.far_shard_paths)
+        return (encoder, fsa_paths)
+
+    def _making(
         self,
+        count_path: Optional[str],
+        encoder: pynini.EncodeMapper,
         order: int,
         target_number_of_ngrams: int,
         smoothing_method: str,
         shrinking_method: bool,
         model_path: str,
-    ):
-        with pynini.Far(self.far_path, mode="r") as far_reader:
-            encoder = pynini.EncodeMapper(
-                far_reader.arc_type(), encode_labels=True
+        fsa_path: Optional[str] = None,
+    ) -> None:
+        """Makes, optionally shrinks, and decodes an LM from counts.
+
+        If `fsa_path` is given, the n-grams are counted from it at the head
+        of the same pipeline rather than read from `count_path`."""
+        lm_path = self._temp("lm.", ".fst")
+        cmds = []
+        if fsa_path is not None:
+            cmds.append(
+                [
+                    "ngramcount",
+                    "--require_symbols=false",
+                    f"--order={order}",
+                    fsa_path,
+                ]
+            )
+            cmds.append(["ngrammake", f"--method={smoothing_method}"])
+        else:
+            cmds.append(
+                ["ngrammake", f"--method={smoothing_method}", count_path]
             )
-            # Encoding the alignments.
-            with pynini.Far(
-                self.fsa_path,
-                mode="w",
-                arc_type=far_reader.arc_type(),
-                far_type="default",
-            ) as far_writer:
-                while not far_reader.done():
-                    fst = far_reader.get_fst()
-                    fst.encode(encoder)
-                    far_writer.add(far_reader.get_key(), fst)
-                    far_reader.next()
-        logging.info("Building the LM.")
-        cmd = [
-            "ngramcount",
-            "--require_symbols=false",
-            f"--order={order}",
-            self.fsa_path,
-            self.count_path,
-        ]
-        subprocess.check_call(cmd)
-        os.remove(self.fsa_path)
-        cmd = [
-            "ngrammake",
-            f"--method={smoothing_method}",
-            self.count_path,
-            self.lm_path,
-        ]
-        subprocess.check_call(cmd)
-        os.remove(self.count_path)
         # Shrinking the LM
         if shrinking_method:
-            cmd = [
-                "ngramshrink",
-                "--method=relative_entropy",
-                f"--target_number_of_ngrams={target_number_of_ngrams}",
-                self.lm_path,
-                self.shrunk_lm_path,
-            ]
-            subprocess.check_call(cmd)
-            self.lm_path = self.shrunk_lm_path
+            cmds.append(
+                [
+                    "ngramshrink",
+                    "--method=relative_entropy",
+                    f"--target_number_of_ngrams={target_number_of_ngrams}",
+                ]
+            )
+        # The stages stream into each other, so only the final LM is written.
+        with self._measure(
+            "ngrammake",
+            order=order,
+            smoothing_method=smoothing_method,
+            shrinking_method=shrinking_method,
+        ) as record:
+            record["children"] = _pipeline(cmds, lm_path)
+            record["fst_path"] = lm_path
         logging.info(
             "%s-gram %s Language model is trained.", order, smoothing_method
         )
         # Decoding the LM
-        model = pynini.Fst.read(self.lm_path)
-        os.remove(self.lm_path)
-        model.decode(encoder)
-        model.write(model_path)
+        with self._measure(
+            "decode", order=order, smoothing_method=smoothing_method
+        ) as record:
+            model = pynini.Fst.read(lm_path)
+            os.remove(lm_path)
+            model.decode(encoder)
+            model.write(model_path)
+            record["fst"] = model
         logging.info(
             "%s-gram %s Language model is built.", order, smoothing_method
         )
 
-    def train(
+    def _restore(
+        self, stage: str, key: Optional[str]
+    ) -> Optional[stage_cache.Artifacts]:
+        if self.cache is None:
+            return None
+        return self.cache.get(stage, key)
+
+    def _store(
+        self,
+        stage: str,
+        key: Optional[str],
+        artifacts: stage_cache.Artifacts,
+    ) -> stage_cache.Artifacts:
+        if self.cache is None:
+            return artifacts
+        return self.cache.put(stage, key, artifacts)
+
+    def _subkey(self, key: Optional[str], *params: Any) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return stage_cache._key(key, *params)
+
+    def _release(self, *paths: str) -> None:
+        """Removes intermediate files unless they belong to the cache."""
+        for path in paths:
+            if self.cache is None or not self.cache.owns(path):
+                os.remove(path)
+
+    def _setup(
         self,
         input_path: str,
         token_type: str,
         input_epsilon: bool,
         output_epsilon: bool,
+    ) -> None:
+        """Records the lexicon parameters and derives the stage keys."""
+        self.lexicon_args = (
+            token_type,
+            input_path,
+            input_epsilon,
+            output_epsilon,
+        )
+        self.encoded = None
+        self.counts = {}
+        self.keys = {}
+        self.report = []
+        if self.cache is None:
+            return
+        logging.info("Hashing %s", input_path)
+        token_key = token_type
+        if token_type not in {"byte", "utf8"}:
+            token_key = stage_cache._file_hash(token_type)
+        self.keys["lexicon"] = stage_cache._key(
+            stage_cache._file_hash(input_path),
+            token_key,
+            input_epsilon,
+            output_epsilon,
+            self.shard_size,
+            self.dedup,
+        )
+        self.keys["alignment"] = self._subkey(
+            self.keys["lexicon"], self.aligner_shards
+        )
+        self.keys["encoding"] = self._subkey(
+            self.keys["alignment"], self.sharded_counting
+        )
+
+    def _lexicon_stage(self) -> None:
+        artifacts = self._restore("lexicon", self.keys.get("lexicon"))
+        if artifacts is None:
+            with self._measure("lexicon") as record:
+                record["children"] = self._lexicon_covering(
+                    *self.lexicon_args
+                )
+                record["fst_path"] = self.covering_path
+            artifacts = self._store(
+                "lexicon",
+                self.keys.get("lexicon"),
+                {
+                    "g": self.g_shard_paths,
+                    "p": self.p_shard_paths,
+                    "covering": self.covering_path,
+                },
+            )
+        self.g_shard_paths = artifacts["g"]
+        self.p_shard_paths = artifacts["p"]
+        self.covering_path = artifacts["covering"]
+
+    def _alignment_stage(self) -> None:
+        artifacts = self._restore("alignment", self.keys.get("alignment"))
+        if artifacts is None:
+            self._lexicon_stage()
+            self._alignment()
+            artifacts = self._store(
+                "alignment",
+                self.keys.get("alignment"),
+                {"far": self.far_shard_paths},
+            )
+        self.far_shard_paths = artifacts["far"]
+
+    def _encoding_stage(self) -> Tuple[pynini.EncodeMapper, List[str]]:
+        """Returns the encoder and encoded FARs, computing them once."""
+        with self.lock:
+            if self.encoded is not None:
+                return self.encoded
+            artifacts = self._restore("encoding", self.keys.get("encoding"))
+            if artifacts is None:
+                self._alignment_stage()
+                with self._measure("encoding"):
+                    self.encoded = self._encoding()
+                if self.cache is None:
+                    return self.encoded
+                encoder_path = self._temp("encoder.", ".enc")
+                self.encoded[0].write(encoder_path)
+                artifacts = self._store(
+                    "encoding",
+                    self.keys.get("encoding"),
+                    {"encoder": encoder_path, "fsa": self.encoded[1]},
+                )
+            self.encoded = (
+                pynini.EncodeMapper.read(artifacts["encoder"]),
+                artifacts["fsa"],
+            )
+            return self.encoded
+
+    def _counting_stage(self, order: int) -> Tuple[pynini.EncodeMapper, str]:
+        """Returns the encoder and counts of an order, computing them once."""
+        with self.lock:
+            if order in self.counts:
+                return self.counts[order]
+            key = self._subkey(self.keys.get("encoding"), order)
+            artifacts = self._restore("counts", key)
+            if artifacts is None:
+                (encoder, fsa_paths) = self._encoding_stage()
+                logging.info("Building the %d-gram LM.", order)
+                count_path = self._temp("count.", ".fst")
+                self._counting(order, fsa_paths, count_path)
+                if self.cache is None:
+                    self.counts[order] = (encoder, count_path)
+                    return self.counts[order]
+                # The encoder is stored alongside, so a hit here needs no
+                # earlier stage.
+                encoder_path = self._temp("encoder.", ".enc")
+                encoder.write(encoder_path)
+                artifacts = self._store(
+                    "counts",
+                    key,
+                    {"encoder": encoder_path, "count": count_path},
+                )
+            self.counts[order] = (
+                pynini.EncodeMapper.read(artifacts["encoder"]),
+                artifacts["count"],
+            )
+            return self.counts[order]
+
+    def _model_stage(
+        self,
         order: int,
         target_number_of_ngrams: int,
         smoothing_method: str,
         shrinking_method: bool,
         model_path: str,
-    ):
-        self._lexicon_covering(
-            token_type, input_path, input_epsilon, output_epsilon
+        fused: bool = False,
+    ) -> None:
+        """Builds a model, or copies it from the cache.
+
+        If `fused` is set and neither the counts are kept nor the counting
+        is sharded, the n-grams are counted in the same pipeline that makes
+        the LM."""
+        key = self._subkey(
+            self._subkey(self.keys.get("encoding"), order),
+            smoothing_method,
+            shrinking_method,
+            target_number_of_ngrams,
         )
-        self._alignment()
-        self._building_model(
+        artifacts = self._restore("model", key)
+        if artifacts is None:
+            if (
+                fused
+                and self.cache is None
+                and not self.sharded_counting
+                and order not in self.counts
+            ):
+                (encoder, fsa_paths) = self._encoding_stage()
+                logging.info("Building the %d-gram LM.", order)
+                self._making(
+                    None,
+                    encoder,
+                    order,
+                    target_number_of_ngrams,
+                    smoothing_method,
+                    shrinking_method,
+                    model_path,
+                    fsa_path=fsa_paths[0],
+                )
+                return
+            (encoder, count_path) = self._counting_stage(order)
+            if self.cache is None:
+                self._making(
+                    count_path,
+                    encoder,
+                    order,
+                    target_number_of_ngrams,
+                    smoothing_method,
+                    shrinking_method,
+                    model_path,
+                )
+                return
+            lm_path = self._temp("model.", ".fst")
+            self._making(
+                count_path,
+                encoder,
+                order,
+                target_number_of_ngrams,
+                smoothing_method,
+                shrinking_method,
+                lm_path,
+            )
+            artifacts = self._store("model", key, {"model": lm_path})
+        shutil.copyfile(artifacts["model"], model_path)
+
+    def _cleanup(self) -> None:
+        """Removes the encoded FARs and counts not kept by the cache."""
+        if self.encoded is not None:
+            self._release(*self.encoded[1])
+        for (_, count_path) in self.counts.values():
+            self._release(count_path)
+
+    def _building_model(
+        self,
+        order: int,
+        target_number_of_ngrams: int,
+        smoothing_method: str,
+        shrinking_method: bool,
+        model_path: str,
+    ):
+        self._model_stage(
             order,
             target_number_of_ngrams,
             smoothing_method,
             shrinking_method,
             model_path,
+            fused=True,
         )
+        self._cleanup()
+
+    def train(
+        self,
+        input_path: str,
+        token_type: str,
+        input_epsilon: bool,
+        output_epsilon: bool,
+        order: int,
+        target_number_of_ngrams: int,
+        smoothing_method: str,
+        shrinking_method: bool,
+        model_path: str,
+    ):
+        # Each stage is only run if its output is not cached, pulling in the
+        # earlier stages it needs.
+        with self._scratch():
+            self._setup(
+                input_path, token_type, input_epsilon, output_epsilon
+            )
+            self._building_model(
+                order,
+                target_number_of_ngrams,
+                smoothing_method,
+                shrinking_method,
+                model_path,
+            )
+
+    def sweep(
+        self,
+        input_path: str,
+        token_type: str,
+        input_epsilon: bool,
+        output_epsilon: bool,
+        orders: List[int],
+        target_number_of_ngrams: int,
+        smoothing_methods: List[str],
+        shrinking_method: bool,
+        model_dir: str,
+        dev_path: str,
+    ) -> List[Tuple[int, str, float, float, str]]:
+        """Trains and evaluates a model for every order and smoothing method.
+
+        The lexicon is aligned and encoded once, and counted once per order;
+        only the LMs are made per smoothing method, in parallel. Returns
+        (order, smoothing method, WER, LER, model path) tuples, best first."""
+        with self._scratch():
+            self._setup(input_path, token_type, input_epsilon, output_epsilon)
+            models = []
+            with self._drivers() as pool:
+                for order in orders:
+                    jobs = []
+                    for smoothing_method in smoothing_methods:
+                        model_path = os.path.join(
+                            model_dir, f"{order}_{smoothing_method}_model.fst"
+                        )
+                        jobs.append(
+                            (
+                                order,
+                                target_number_of_ngrams,
+                                smoothing_method,
+                                shrinking_method,
+                                model_path,
+                            )
+                        )
+                        models.append((order, smoothing_method, model_path))
+                    pool.starmap(self._model_stage, jobs)
+                    # Counts of this order are no longer needed.
+                    if order in self.counts:
+                        self._release(self.counts.pop(order)[1])
+            self._cleanup()
+        logging.info("Evaluating %d models on %s", len(models), dev_path)
+        with multiprocessing.Pool(self.processes) as pool:
+            scores = pool.starmap(
+                _dev_score,
+                [(path, token_type, dev_path) for (_, _, path) in models],
+            )
+        results = [
+            (order, smoothing_method, wer, ler, path)
+            for ((order, smoothing_method, path), (wer, ler)) in zip(
+                models, scores
+            )
+        ]
+        results.sort(key=lambda result: (result[2], result[3]))
+        return results
+
+
+def _write_report(report: List[Dict[str, Any]], path: str) -> None:
+    """Writes the per-stage report as JSON."""
+    with open(path, "w") as sink:
+        json.dump({"stages": report}, sink, indent=2)
+    logging.info("Report of %d stages is written to %s", len(report), path)
 
 
 def main(args: argparse.Namespace) -> None:
-    trainer = PairNGramTrainer()
+    cache = None
+    if args.cache_dir:
+        cache = stage_cache.StageCache(
+            args.cache_dir, int(args.cache_max_gb * (1 << 30))
+        )
+    trainer = PairNGramTrainer(
+        args.processes,
+        args.shard_size,
+        args.aligner_shards,
+        args.sharded_counting,
+        cache,
+        args.scratch_dir,
+        args.dedup,
+        bool(args.report_path),
+    )
+    if args.dev_path:
+        os.makedirs(args.model_path, exist_ok=True)
+        results = trainer.sweep(
+            args.input_path,
+            args.token_type,
+            args.input_epsilon,
+            args.output_epsilon,
+            args.sweep_orders or [args.order],
+            args.target_number_of_ngrams,
+            args.sweep_smoothing_methods or [args.smoothing_method],
+            args.shrinking_method,
+            args.model_path,
+            args.dev_path,
+        )
+        with open(args.results_path, "w") as sink:
+            print(
+                "order",
+                "smoothing_method",
+                "WER",
+                "LER",
+                "model_path",
+                sep="\t",
+                file=sink,
+            )
+            for (order, smoothing_method, wer, ler, path) in results:
+                logging.info(
+                    "%d-gram %s:\tWER %.4f\tLER %.4f",
+                    order,
+                    smoothing_method,
+                    wer,
+                    ler,
+                )
+                print(
+                    order,
+                    smoothing_method,
+                    f"{wer:.4f}",
+                    f"{ler:.4f}",
+                    path,
+                    sep="\t",
+                    file=sink,
+                )
+        if args.report_path:
+            _write_report(trainer.report, args.report_path)
+        return
     trainer.train(
         args.input_path,
         args.token_type,
@@ -236,6 +1114,27 @@ def main(args: argparse.Namespace) -> None:
         args.shrinking_method,
         args.model_path,
     )
+    if args.report_path:
+        _write_report(trainer.report, args.report_path)
+    if args.bundle_path:
+        params = {
+            "order": args.order,
+            "smoothing_method": args.smoothing_method,
+            "shrinking_method": args.shrinking_method,
+            "target_number_of_ngrams": args.target_number_of_ngrams,
+        }
+        digest = bundle._write(
+            args.bundle_path,
+            pynini.Fst.read(args.model_path),
+            _type_reader(args.token_type),
+            params,
+            args.bundle_fst_type,
+        )
+        logging.info("Model bundle %s is written.", digest)
+    if args.lexicon_path:
+        lexicon = build_lexicon._compile(args.input_path, args.token_type)
+        logging.info("Lexicon index has %d unique words", len(lexicon))
+        build_lexicon._write(lexicon, args.lexicon_path)
 
 
 if __name__ == "__main__":
@@ -260,7 +1159,7 @@ if __name__ == "__main__":
         help="allows input phonemes to have a null alignment (default: %(default)s)",
     )
     parser.add_argument(
-        "--order", default="6", help="input the order of ngram"
+        "--order", type=int, default=6, help="input the order of ngram"
     )
     parser.add_argument(
         "--smoothing_method",
@@ -274,10 +1173,95 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--target_number_of_ngrams",
+        type=int,
         default=100000,
         help="input the target number of ngrams (default: %(default)s)",
     )
     parser.add_argument(
         "--model_path", required=True, help="input result FST path"
     )
+    parser.add_argument(
+        "--dev_path",
+        help="development TSV file path; if given, trains one model per "
+        "order and smoothing method into the --model_path directory and "
+        "evaluates each on it",
+    )
+    parser.add_argument(
+        "--sweep_orders",
+        type=int,
+        nargs="+",
+        help="orders to sweep over (default: --order)",
+    )
+    parser.add_argument(
+        "--sweep_smoothing_methods",
+        nargs="+",
+        help="smoothing methods to sweep over (default: --smoothing_method)",
+    )
+    parser.add_argument(
+        "--results_path",
+        default="/dev/stdout",
+        help="output sweep results TSV path (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=100000,
+        help="number of examples per lexicon shard (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--aligner_shards",
+        type=int,
+        help="train the aligner on only this many shards; examples with "
+        "label pairs unseen in them may fail to align",
+    )
+    parser.add_argument(
+        "--sharded_counting",
+        action="store_true",
+        help="count n-grams per shard in parallel and merge the counts",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="directory of the stage cache; stages whose inputs and "
+        "parameters are unchanged are reused from it",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=20,
+        help="size limit of the stage cache in GiB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="compile and decode each distinct pair in the lexicon once; "
+        "aligner training and n-gram counting still see every occurrence",
+    )
+    parser.add_argument(
+        "--report_path",
+        help="optional output JSON path for the wall time, CPU time, peak "
+        "RSS and output FST size of each training stage",
+    )
+    parser.add_argument(
+        "--scratch_dir",
+        help="directory to hold the intermediate files of a run, e.g. on a "
+        "tmpfs (default: the system temporary directory)",
+    )
+    parser.add_argument(
+        "--bundle_path", help="optional output model bundle path"
+    )
+    parser.add_argument(
+        "--bundle_fst_type",
+        default="const",
+        choices=bundle.FST_TYPES,
+        help="FST type stored in the bundle (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--lexicon_path",
+        help="optional output lexicon index path for rewrite.py",
+    )
     main(parser.parse_args())